@@ -0,0 +1,73 @@
+#
+# compares the fov backends of libtcodpy: the native library and the pure
+# python one. builds random maps the size of the game's, computes the fov
+# from random spots with each backend, checks both agree and prints timings.
+#
+# usage: python fov_benchmark.py [computes] [width] [height]
+#
+
+import sys
+import time
+import numpy
+import libtcodpy as libtcod
+
+RADIUS = 13
+LIGHT_WALLS = True
+ALGORITHMS = [('FOV_BASIC', libtcod.FOV_BASIC), ('FOV_SHADOW', libtcod.FOV_SHADOW)]
+
+def random_map(rng, width, height):
+	#roughly three quarters floor, with a solid border
+	transparent = rng.rand(height, width) > 0.25
+	transparent[0, :] = transparent[-1, :] = False
+	transparent[:, 0] = transparent[:, -1] = False
+	return transparent
+
+def run(backend, maps, spots, algo):
+	#time the fov computations (plus reading the result) on one backend
+	libtcod.map_set_backend(backend)
+	fov_maps = []
+	for transparent in maps:
+		m = libtcod.map_new(transparent.shape[1], transparent.shape[0])
+		libtcod.map_set_properties_bulk(m, transparent, transparent)
+		fov_maps.append(m)
+
+	results = []
+	start = time.time()
+	for (m, (x, y)) in zip(fov_maps, spots):
+		libtcod.map_compute_fov(m, x, y, RADIUS, LIGHT_WALLS, algo)
+		results.append(libtcod.map_get_fov(m))
+	elapsed = time.time() - start
+
+	for m in fov_maps:
+		libtcod.map_delete(m)
+	return elapsed, results
+
+def main():
+	computes = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	width = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+	height = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+	backends = [libtcod.FOV_BACKEND_PYTHON]
+	if libtcod.LIB_LOADED:
+		backends.insert(0, libtcod.FOV_BACKEND_C)
+
+	rng = numpy.random.RandomState(1234)
+	maps = [random_map(rng, width, height) for i in range(computes)]
+	spots = [(rng.randint(1, width - 1), rng.randint(1, height - 1)) for i in range(computes)]
+
+	print('%d fov computations on %dx%d maps, radius %d' % (computes, width, height, RADIUS))
+	for (name, algo) in ALGORITHMS:
+		timings = {}
+		results = {}
+		for backend in backends:
+			(timings[backend], results[backend]) = run(backend, maps, spots, algo)
+			print('%-10s %-7s %8.3f ms per fov' % (name, backend, 1000.0 * timings[backend] / computes))
+
+		if len(backends) > 1:
+			mismatches = sum(1 for (a, b) in zip(*[results[backend] for backend in backends])
+				if (a != b).any())
+			print('%-10s backends disagree on %d of %d computations, c is %.1fx faster' % (name,
+				mismatches, computes, timings[libtcod.FOV_BACKEND_PYTHON] / max(timings[libtcod.FOV_BACKEND_C], 1e-9)))
+
+if __name__ == '__main__':
+	main()
@@ -25,8 +25,13 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import os
 import sys
+import math
+import random
 import ctypes
+import collections
+import heapq
 import struct
 from ctypes import *
 
@@ -39,41 +44,67 @@ try:  #import NumPy if available
 except ImportError:
     numpy_available = False
 
+class _MissingFunction(object):
+    # stands in for a function of the native library when it could not be
+    # loaded. accepts restype/argtypes like a ctypes function, fails on call.
+    def __init__(self, name, error):
+        self.name = name
+        self.error = error
+
+    def __call__(self, *args):
+        raise RuntimeError('%s needs the native libtcod library, which could not be loaded: %s' % (self.name, self.error))
+
+class _MissingLibrary(object):
+    # stands in for the native library, so that the module stays importable
+    # and the pure python parts (fov backend, colors, structures) still work
+    def __init__(self, error):
+        self._error = error
+
+    def __getattr__(self, name):
+        func = _MissingFunction(name, self._error)
+        setattr(self, name, func)
+        return func
+
 LINUX=False
 MAC=False
 MINGW=False
 MSVC=False
-if sys.platform.find('linux') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
-    LINUX=True
-elif sys.platform.find('darwin') != -1:
-    _lib = ctypes.cdll['./libtcod.dylib']
-    MAC = True
-elif sys.platform.find('haiku') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
-    HAIKU = True
-else:
-    try:
-        _lib = ctypes.cdll['./libtcod-mingw.dll']
-        MINGW=True
-    except WindowsError:
-        _lib = ctypes.cdll['./libtcod-VS.dll']
-        MSVC=True
-    # On Windows, ctypes doesn't work well with function returning structs,
-    # so we have to user the _wrapper functions instead
-    _lib.TCOD_color_multiply = _lib.TCOD_color_multiply_wrapper
-    _lib.TCOD_color_add = _lib.TCOD_color_add_wrapper
-    _lib.TCOD_color_multiply_scalar = _lib.TCOD_color_multiply_scalar_wrapper
-    _lib.TCOD_color_subtract = _lib.TCOD_color_subtract_wrapper
-    _lib.TCOD_color_lerp = _lib.TCOD_color_lerp_wrapper
-    _lib.TCOD_console_get_default_background = _lib.TCOD_console_get_default_background_wrapper
-    _lib.TCOD_console_get_default_foreground = _lib.TCOD_console_get_default_foreground_wrapper
-    _lib.TCOD_console_get_char_background = _lib.TCOD_console_get_char_background_wrapper
-    _lib.TCOD_console_get_char_foreground = _lib.TCOD_console_get_char_foreground_wrapper
-    _lib.TCOD_console_get_fading_color = _lib.TCOD_console_get_fading_color_wrapper
-    _lib.TCOD_image_get_pixel = _lib.TCOD_image_get_pixel_wrapper
-    _lib.TCOD_image_get_mipmap_pixel = _lib.TCOD_image_get_mipmap_pixel_wrapper
-    _lib.TCOD_parser_get_color_property = _lib.TCOD_parser_get_color_property_wrapper
+try:
+    if sys.platform.find('linux') != -1:
+        _lib = ctypes.cdll['./libtcod.so']
+        LINUX=True
+    elif sys.platform.find('darwin') != -1:
+        _lib = ctypes.cdll['./libtcod.dylib']
+        MAC = True
+    elif sys.platform.find('haiku') != -1:
+        _lib = ctypes.cdll['./libtcod.so']
+        HAIKU = True
+    else:
+        try:
+            _lib = ctypes.cdll['./libtcod-mingw.dll']
+            MINGW=True
+        except WindowsError:
+            _lib = ctypes.cdll['./libtcod-VS.dll']
+            MSVC=True
+        # On Windows, ctypes doesn't work well with function returning structs,
+        # so we have to user the _wrapper functions instead
+        _lib.TCOD_color_multiply = _lib.TCOD_color_multiply_wrapper
+        _lib.TCOD_color_add = _lib.TCOD_color_add_wrapper
+        _lib.TCOD_color_multiply_scalar = _lib.TCOD_color_multiply_scalar_wrapper
+        _lib.TCOD_color_subtract = _lib.TCOD_color_subtract_wrapper
+        _lib.TCOD_color_lerp = _lib.TCOD_color_lerp_wrapper
+        _lib.TCOD_console_get_default_background = _lib.TCOD_console_get_default_background_wrapper
+        _lib.TCOD_console_get_default_foreground = _lib.TCOD_console_get_default_foreground_wrapper
+        _lib.TCOD_console_get_char_background = _lib.TCOD_console_get_char_background_wrapper
+        _lib.TCOD_console_get_char_foreground = _lib.TCOD_console_get_char_foreground_wrapper
+        _lib.TCOD_console_get_fading_color = _lib.TCOD_console_get_fading_color_wrapper
+        _lib.TCOD_image_get_pixel = _lib.TCOD_image_get_pixel_wrapper
+        _lib.TCOD_image_get_mipmap_pixel = _lib.TCOD_image_get_mipmap_pixel_wrapper
+        _lib.TCOD_parser_get_color_property = _lib.TCOD_parser_get_color_property_wrapper
+    LIB_LOADED = True
+except OSError as e:
+    _lib = _MissingLibrary(e)
+    LIB_LOADED = False
 
 HEXVERSION = 0x010501
 STRVERSION = "1.5.1"
@@ -464,6 +495,14 @@ class ConsoleBuffer:
             console_get_height(dest) != self.height):
             raise ValueError('ConsoleBuffer.blit: Destination console has an incorrect size.')
 
+        if _headless_console(dest) is not None:
+            if fill_back:
+                console_fill_background(dest, self.back_r, self.back_g, self.back_b)
+            if fill_fore:
+                console_fill_foreground(dest, self.fore_r, self.fore_g, self.fore_b)
+                console_fill_char(dest, self.char)
+            return
+
         s = struct.Struct('%di' % len(self.back_r))
 
         if fill_back:
@@ -473,6 +512,97 @@ class ConsoleBuffer:
             _lib.TCOD_console_fill_foreground(dest, (c_int * len(self.fore_r))(*self.fore_r), (c_int * len(self.fore_g))(*self.fore_g), (c_int * len(self.fore_b))(*self.fore_b))
             _lib.TCOD_console_fill_char(dest, (c_int * len(self.char))(*self.char))
 
+class NumpyConsoleBuffer:
+    # a ConsoleBuffer kept in numpy arrays of rows, like the console itself.
+    # blit hands the arrays' memory to the "fill" functions as they are, and
+    # set_rect and set_mask change whole areas at once. needs numpy.
+    def __init__(self, width, height, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
+        if not numpy_available:
+            raise RuntimeError('NumpyConsoleBuffer needs numpy.')
+        self.width = width
+        self.height = height
+        # colors are (3, height, width): one contiguous array per component
+        self.back = numpy.empty((3, height, width), dtype=numpy.intc)
+        self.fore = numpy.empty((3, height, width), dtype=numpy.intc)
+        self.char = numpy.empty((height, width), dtype=numpy.intc)
+        self.clear(back_r, back_g, back_b, fore_r, fore_g, fore_b, char)
+
+    def clear(self, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
+        # clears the console. values to fill it with are optional, defaults
+        # to black with no characters.
+        self.set_rect(0, 0, self.width, self.height, (back_r, back_g, back_b), (fore_r, fore_g, fore_b), char)
+
+    def copy(self):
+        # returns a copy of this NumpyConsoleBuffer.
+        other = NumpyConsoleBuffer(self.width, self.height)
+        other.back[...] = self.back
+        other.fore[...] = self.fore
+        other.char[...] = self.char
+        return other
+
+    def set_fore(self, x, y, r, g, b, char):
+        # set the character and foreground color of one cell.
+        self.fore[:, y, x] = (r, g, b)
+        self.char[y, x] = ord(char)
+
+    def set_back(self, x, y, r, g, b):
+        # set the background color of one cell.
+        self.back[:, y, x] = (r, g, b)
+
+    def set(self, x, y, back_r, back_g, back_b, fore_r, fore_g, fore_b, char):
+        # set the background color, foreground color and character of one cell.
+        self.back[:, y, x] = (back_r, back_g, back_b)
+        self.fore[:, y, x] = (fore_r, fore_g, fore_b)
+        self.char[y, x] = ord(char)
+
+    def set_rect(self, x, y, w, h, back=None, fore=None, char=None):
+        # set the cells of a rectangle. back and fore are Colors or (r, g, b)
+        # triples; whatever is None is left as it is.
+        self._set_area((slice(y, y + h), slice(x, x + w)), None, back, fore, char)
+
+    def set_mask(self, mask, back=None, fore=None, char=None, x=0, y=0):
+        # same, for the cells where mask (an array of rows, placed at x, y) is
+        # true.
+        mask = numpy.asarray(mask, dtype=bool)
+        (h, w) = mask.shape
+        self._set_area((slice(y, y + h), slice(x, x + w)), mask, back, fore, char)
+
+    def _set_area(self, area, mask, back, fore, char):
+        layers = []
+        if back is not None:
+            layers.extend(zip(self.back, tuple(back)))
+        if fore is not None:
+            layers.extend(zip(self.fore, tuple(fore)))
+        if char is not None:
+            layers.append((self.char, ord(char)))
+        for (layer, value) in layers:
+            if mask is None:
+                layer[area] = value
+            else:
+                layer[area][mask] = value
+
+    def blit(self, dest, fill_fore=True, fill_back=True):
+        # use libtcod's "fill" functions to write the buffer to a console.
+        if (console_get_width(dest) != self.width or
+            console_get_height(dest) != self.height):
+            raise ValueError('NumpyConsoleBuffer.blit: Destination console has an incorrect size.')
+
+        h = _headless_console(dest)
+        if h is not None:
+            if fill_back:
+                h.back[...] = numpy.rollaxis(self.back, 0, 3)
+            if fill_fore:
+                h.fore[...] = numpy.rollaxis(self.fore, 0, 3)
+                h.char[...] = self.char
+            return
+
+        if fill_back:
+            _lib.TCOD_console_fill_background(dest, *[layer.ctypes.data_as(POINTER(c_int)) for layer in self.back])
+
+        if fill_fore:
+            _lib.TCOD_console_fill_foreground(dest, *[layer.ctypes.data_as(POINTER(c_int)) for layer in self.fore])
+            _lib.TCOD_console_fill_char(dest, self.char.ctypes.data_as(POINTER(c_int)))
+
 _lib.TCOD_console_credits_render.restype = c_bool
 _lib.TCOD_console_is_fullscreen.restype = c_bool
 _lib.TCOD_console_is_window_closed.restype = c_bool
@@ -692,15 +822,28 @@ RIGHT=1
 CENTER=2
 # initializing the console
 def console_init_root(w, h, title, fullscreen=False, renderer=RENDERER_SDL):
+    global _headless_root, _headless_closed
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        _headless_root = _HeadlessConsole(w, h)
+        _headless_closed = False
+        return
     _lib.TCOD_console_init_root(w, h, c_char_p(title), fullscreen, renderer)
 
 def console_get_width(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.width
     return _lib.TCOD_console_get_width(con)
 
 def console_get_height(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.height
     return _lib.TCOD_console_get_height(con)
 
 def console_set_custom_font(fontFile, flags=FONT_LAYOUT_ASCII_INCOL, nb_char_horiz=0, nb_char_vertic=0):
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return
     _lib.TCOD_console_set_custom_font(c_char_p(fontFile), flags, nb_char_horiz, nb_char_vertic)
 
 def console_map_ascii_code_to_font(asciiCode, fontCharX, fontCharY):
@@ -727,15 +870,23 @@ def console_map_string_to_font(s, fontCharX, fontCharY):
         _lib.TCOD_console_map_string_to_font_utf(s, fontCharX, fontCharY)
 
 def console_is_fullscreen():
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return False
     return _lib.TCOD_console_is_fullscreen()
 
 def console_set_fullscreen(fullscreen):
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return
     _lib.TCOD_console_set_fullscreen(c_int(fullscreen))
 
 def console_is_window_closed():
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _headless_closed
     return _lib.TCOD_console_is_window_closed()
 
 def console_set_window_title(title):
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return
     _lib.TCOD_console_set_window_title(c_char_p(title))
 
 def console_credits():
@@ -748,85 +899,169 @@ def console_credits_render(x, y, alpha):
     return _lib.TCOD_console_credits_render(x, y, c_int(alpha))
 
 def console_flush():
+    global _headless_frame
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        root = _headless_root
+        _headless_frame = (root.char.copy(), root.fore.copy(), root.back.copy())
+        return
     _lib.TCOD_console_flush()
 
 # drawing on a console
 def console_set_default_background(con, col):
+    h = _headless_console(con)
+    if h is not None:
+        h.default_back = tuple(col)
+        return
     _lib.TCOD_console_set_default_background(con, col)
 
 def console_set_default_foreground(con, col):
+    h = _headless_console(con)
+    if h is not None:
+        h.default_fore = tuple(col)
+        return
     _lib.TCOD_console_set_default_foreground(con, col)
 
 def console_clear(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.clear()
     return _lib.TCOD_console_clear(con)
 
 def console_put_char(con, x, y, c, flag=BKGND_DEFAULT):
+    h = _headless_console(con)
+    if h is not None:
+        if type(c) == str or type(c) == bytes:
+            c = ord(c)
+        return h.put_char(x, y, c, flag)
     if type(c) == str or type(c) == bytes:
         _lib.TCOD_console_put_char(con, x, y, ord(c), flag)
     else:
         _lib.TCOD_console_put_char(con, x, y, c, flag)
 
 def console_put_char_ex(con, x, y, c, fore, back):
+    h = _headless_console(con)
+    if h is not None:
+        if type(c) == str or type(c) == bytes:
+            c = ord(c)
+        if 0 <= x < h.width and 0 <= y < h.height:
+            h.char[y, x] = c
+            h.fore[y, x] = tuple(fore)
+            h.back[y, x] = tuple(back)
+        return
     if type(c) == str or type(c) == bytes:
         _lib.TCOD_console_put_char_ex(con, x, y, ord(c), fore, back)
     else:
         _lib.TCOD_console_put_char_ex(con, x, y, c, fore, back)
 
 def console_set_char_background(con, x, y, col, flag=BKGND_SET):
+    h = _headless_console(con)
+    if h is not None:
+        if 0 <= x < h.width and 0 <= y < h.height:
+            h.set_back((y, x), col, flag)
+        return
     _lib.TCOD_console_set_char_background(con, x, y, col, flag)
 
 def console_set_char_foreground(con, x, y, col):
+    h = _headless_console(con)
+    if h is not None:
+        if 0 <= x < h.width and 0 <= y < h.height:
+            h.fore[y, x] = tuple(col)
+        return
     _lib.TCOD_console_set_char_foreground(con, x, y, col)
 
 def console_set_char(con, x, y, c):
+    h = _headless_console(con)
+    if h is not None:
+        if 0 <= x < h.width and 0 <= y < h.height:
+            h.char[y, x] = ord(c) if type(c) == str or type(c) == bytes else c
+        return
     if type(c) == str or type(c) == bytes:
         _lib.TCOD_console_set_char(con, x, y, ord(c))
     else:
         _lib.TCOD_console_set_char(con, x, y, c)
 
 def console_set_background_flag(con, flag):
+    h = _headless_console(con)
+    if h is not None:
+        h.bkgnd_flag = flag
+        return
     _lib.TCOD_console_set_background_flag(con, c_int(flag))
 
 def console_get_background_flag(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.bkgnd_flag
     return _lib.TCOD_console_get_background_flag(con)
 
 def console_set_alignment(con, alignment):
+    h = _headless_console(con)
+    if h is not None:
+        h.alignment = alignment
+        return
     _lib.TCOD_console_set_alignment(con, c_int(alignment))
 
 def console_get_alignment(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.alignment
     return _lib.TCOD_console_get_alignment(con)
 
 def console_print(con, x, y, fmt):
+    h = _headless_console(con)
+    if h is not None:
+        h.print_lines(x, y, 0, 0, h.bkgnd_flag, h.alignment, fmt)
+        return
     if type(fmt) == bytes:
         _lib.TCOD_console_print(c_void_p(con), x, y, c_char_p(fmt))
     else:
         _lib.TCOD_console_print_utf(c_void_p(con), x, y, fmt)
 
 def console_print_ex(con, x, y, flag, alignment, fmt):
+    h = _headless_console(con)
+    if h is not None:
+        h.print_lines(x, y, 0, 0, flag, alignment, fmt)
+        return
     if type(fmt) == bytes:
         _lib.TCOD_console_print_ex(c_void_p(con), x, y, flag, alignment, c_char_p(fmt))
     else:
         _lib.TCOD_console_print_ex_utf(c_void_p(con), x, y, flag, alignment, fmt)
 
 def console_print_rect(con, x, y, w, h, fmt):
+    hc = _headless_console(con)
+    if hc is not None:
+        return hc.print_lines(x, y, w or hc.width - x, h, hc.bkgnd_flag, hc.alignment, fmt)
     if type(fmt) == bytes:
         return _lib.TCOD_console_print_rect(c_void_p(con), x, y, w, h, c_char_p(fmt))
     else:
         return _lib.TCOD_console_print_rect_utf(c_void_p(con), x, y, w, h, fmt)
 
 def console_print_rect_ex(con, x, y, w, h, flag, alignment, fmt):
+    hc = _headless_console(con)
+    if hc is not None:
+        return hc.print_lines(x, y, w or hc.width - x, h, flag, alignment, fmt)
     if type(fmt) == bytes:
         return _lib.TCOD_console_print_rect_ex(c_void_p(con), x, y, w, h, flag, alignment, c_char_p(fmt))
     else:
         return _lib.TCOD_console_print_rect_ex_utf(c_void_p(con), x, y, w, h, flag, alignment, fmt)
 
 def console_get_height_rect(con, x, y, w, h, fmt):
+    hc = _headless_console(con)
+    if hc is not None:
+        lines = len(_headless_wrap(fmt, w or hc.width - x))
+        return min(lines, h) if h > 0 else lines
     if type(fmt) == bytes:
         return _lib.TCOD_console_get_height_rect(c_void_p(con), x, y, w, h, c_char_p(fmt))
     else:
         return _lib.TCOD_console_get_height_rect_utf(c_void_p(con), x, y, w, h, fmt)
 
 def console_rect(con, x, y, w, h, clr, flag=BKGND_DEFAULT):
+    hc = _headless_console(con)
+    if hc is not None:
+        area = hc.clip(x, y, w, h)
+        hc.set_back(area, hc.default_back, flag)
+        if clr:
+            hc.char[area] = ord(' ')
+        return
     _lib.TCOD_console_rect(con, x, y, w, h, c_int(clr), flag)
 
 def console_hline(con, x, y, l, flag=BKGND_DEFAULT):
@@ -842,18 +1077,33 @@ def console_set_color_control(con,fore,back) :
     _lib.TCOD_console_set_color_control(con,fore,back)
 
 def console_get_default_background(con):
+    h = _headless_console(con)
+    if h is not None:
+        return Color(*h.default_back)
     return _lib.TCOD_console_get_default_background(con)
 
 def console_get_default_foreground(con):
+    h = _headless_console(con)
+    if h is not None:
+        return Color(*h.default_fore)
     return _lib.TCOD_console_get_default_foreground(con)
 
 def console_get_char_background(con, x, y):
+    h = _headless_console(con)
+    if h is not None:
+        return Color(*h.back[y, x].tolist())
     return _lib.TCOD_console_get_char_background(con, x, y)
 
 def console_get_char_foreground(con, x, y):
+    h = _headless_console(con)
+    if h is not None:
+        return Color(*h.fore[y, x].tolist())
     return _lib.TCOD_console_get_char_foreground(con, x, y)
 
 def console_get_char(con, x, y):
+    h = _headless_console(con)
+    if h is not None:
+        return int(h.char[y, x])
     return _lib.TCOD_console_get_char(con, x, y)
 
 def console_set_fade(fade, fadingColor):
@@ -869,11 +1119,17 @@ def console_get_fading_color():
 # handling keyboard input
 def console_wait_for_keypress(flush):
     k=Key()
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        _headless_wait_for_event(EVENT_KEY_PRESS, k, None)
+        return k
     _lib.TCOD_console_wait_for_keypress_wrapper(byref(k),c_bool(flush))
     return k
 
 def console_check_for_keypress(flags=KEY_RELEASED):
     k=Key()
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        _headless_next_event(EVENT_KEY_PRESS, k, None)
+        return k
     _lib.TCOD_console_check_for_keypress_wrapper(byref(k),c_int(flags))
     return k
 
@@ -888,22 +1144,35 @@ def console_disable_keyboard_repeat():
 
 # using offscreen consoles
 def console_new(w, h):
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _HeadlessConsole(w, h)
     return _lib.TCOD_console_new(w, h)
 def console_from_file(filename):
     return _lib.TCOD_console_from_file(filename)
 def console_get_width(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.width
     return _lib.TCOD_console_get_width(con)
 
 def console_get_height(con):
+    h = _headless_console(con)
+    if h is not None:
+        return h.height
     return _lib.TCOD_console_get_height(con)
 
 def console_blit(src, x, y, w, h, dst, xdst, ydst, ffade=1.0,bfade=1.0):
+    hsrc = _headless_console(src)
+    if hsrc is not None:
+        return _headless_blit(hsrc, x, y, w, h, _headless_console(dst), xdst, ydst, ffade, bfade)
     _lib.TCOD_console_blit(src, x, y, w, h, dst, xdst, ydst, c_float(ffade), c_float(bfade))
 
 def console_set_key_color(con, col):
     _lib.TCOD_console_set_key_color(con, col)
 
 def console_delete(con):
+    if _headless_console(con) is not None:
+        return
     _lib.TCOD_console_delete(con)
 
 # fast color filling
@@ -911,12 +1180,18 @@ def console_fill_foreground(con,r,g,b) :
     if len(r) != len(g) or len(r) != len(b):
         raise TypeError('R, G and B must all have the same size.')
 
+    h = _headless_console(con)
+    if h is not None:
+        for (i, layer) in enumerate((r, g, b)):
+            h.fore[..., i] = numpy.reshape(layer, (h.height, h.width))
+        return
+
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -932,12 +1207,18 @@ def console_fill_background(con,r,g,b) :
     if len(r) != len(g) or len(r) != len(b):
         raise TypeError('R, G and B must all have the same size.')
 
+    h = _headless_console(con)
+    if h is not None:
+        for (i, layer) in enumerate((r, g, b)):
+            h.back[..., i] = numpy.reshape(layer, (h.height, h.width))
+        return
+
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -950,9 +1231,14 @@ def console_fill_background(con,r,g,b) :
     _lib.TCOD_console_fill_background(con, cr, cg, cb)
 
 def console_fill_char(con,arr) :
+    h = _headless_console(con)
+    if h is not None:
+        h.char[...] = numpy.reshape(arr, (h.height, h.width))
+        return
+
     if (numpy_available and isinstance(arr, numpy.ndarray) ):
         #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
         carr = arr.ctypes.data_as(POINTER(c_int))
     else:
         #otherwise convert using the struct module
@@ -969,6 +1255,211 @@ def console_load_apf(con, filename) :
 def console_save_apf(con, filename) :
     _lib.TCOD_console_save_apf(con,filename)
 
+# console backends: the native library drawing in an SDL window, or a
+# headless one that keeps the cells in numpy arrays, reads its input from a
+# queue of scripted events (sys_push_event) and keeps the last flushed frame
+# for reading back (console_get_frame). choose it before console_init_root.
+# the headless backend doesn't load fonts or images and never waits.
+CONSOLE_BACKEND_SDL = 'sdl'
+CONSOLE_BACKEND_HEADLESS = 'headless'
+
+def console_set_backend(backend):
+    global _console_backend
+    if backend not in (CONSOLE_BACKEND_SDL, CONSOLE_BACKEND_HEADLESS):
+        raise ValueError('Unknown console backend %r.' % (backend,))
+    if backend == CONSOLE_BACKEND_SDL and not LIB_LOADED:
+        raise RuntimeError('The sdl console backend needs the native libtcod library.')
+    if backend == CONSOLE_BACKEND_HEADLESS and not numpy_available:
+        raise RuntimeError('The headless console backend needs numpy.')
+    _console_backend = backend
+
+def console_get_backend():
+    return _console_backend
+
+# default to $LIBTCOD_CONSOLE_BACKEND, or to the native library if it loaded
+if os.environ.get('LIBTCOD_CONSOLE_BACKEND'):
+    console_set_backend(os.environ['LIBTCOD_CONSOLE_BACKEND'])
+elif LIB_LOADED or not numpy_available:
+    _console_backend = CONSOLE_BACKEND_SDL
+else:
+    _console_backend = CONSOLE_BACKEND_HEADLESS
+
+_headless_root = None
+_headless_closed = False
+_headless_frame = None
+_headless_fps = 0
+
+class _HeadlessConsole(object):
+    # console of the headless backend. cells are arrays of rows: the
+    # character codes, and (height, width, 3) foreground and background.
+    def __init__(self, w, h):
+        self.width = w
+        self.height = h
+        self.char = numpy.empty((h, w), dtype=numpy.intc)
+        self.fore = numpy.empty((h, w, 3), dtype=numpy.uint8)
+        self.back = numpy.empty((h, w, 3), dtype=numpy.uint8)
+        self.default_fore = (255, 255, 255)
+        self.default_back = (0, 0, 0)
+        self.bkgnd_flag = BKGND_NONE
+        self.alignment = LEFT
+        self.clear()
+
+    def clear(self):
+        self.char[...] = ord(' ')
+        self.fore[...] = self.default_fore
+        self.back[...] = self.default_back
+
+    def clip(self, x, y, w, h):
+        # the rows and columns of a rectangle that are on the console
+        (x1, y1) = (max(x, 0), max(y, 0))
+        (x2, y2) = (min(x + w, self.width), min(y + h, self.height))
+        return (slice(y1, max(y1, y2)), slice(x1, max(x1, x2)))
+
+    def set_back(self, area, col, flag):
+        if flag == BKGND_DEFAULT:
+            flag = self.bkgnd_flag
+        self.back[area] = _headless_blend(self.back[area], tuple(col), flag)
+
+    def put_char(self, x, y, c, flag):
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.char[y, x] = c
+            self.fore[y, x] = self.default_fore
+            self.set_back((y, x), self.default_back, flag)
+
+    def print_lines(self, x, y, w, h, flag, alignment, text):
+        # print text at x, y (the left, center or right of it, depending on
+        # the alignment), wrapped to w columns if w > 0 and at most h lines
+        # if h > 0. returns the number of lines.
+        lines = _headless_wrap(text, w)
+        if h > 0:
+            lines = lines[:h]
+        for (i, line) in enumerate(lines):
+            if alignment == CENTER:
+                start = x - len(line) // 2
+            elif alignment == RIGHT:
+                start = x - len(line) + 1
+            else:
+                start = x
+            for (j, c) in enumerate(line):
+                self.put_char(start + j, y + i, ord(c), flag)
+        return len(lines)
+
+def _headless_console(con):
+    # the headless console con stands for (0 is the root), or None for a
+    # console of the native library
+    if isinstance(con, _HeadlessConsole):
+        return con
+    if not con and _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _headless_root
+    return None
+
+def _headless_text(fmt):
+    if isinstance(fmt, bytes) and not isinstance(fmt, str):
+        return fmt.decode('latin-1')
+    return fmt
+
+def _headless_wrap(text, w):
+    # split text at newlines and, if w > 0, wrap it at spaces like libtcod
+    lines = []
+    for paragraph in _headless_text(text).split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            if w > 0 and line and len(line) + 1 + len(word) > w:
+                lines.append(line)
+                line = word
+            else:
+                line = line + ' ' + word if line else word
+            while w > 0 and len(line) > w:
+                lines.append(line[:w])
+                line = line[w:]
+        lines.append(line)
+    return lines
+
+def _headless_blend(old, col, flag):
+    # new background colors for old (uint8 array) when drawing col with one
+    # of the BKGND_* flags. the dodge/burn/overlay modes are approximated by
+    # BKGND_SET.
+    mode = flag & 0xff
+    alpha = (flag >> 8) / 255.0
+    if mode == BKGND_NONE:
+        return old
+    old = old.astype(numpy.float32)
+    col = numpy.array(col, dtype=numpy.float32)
+    if mode == BKGND_MULTIPLY:
+        new = old * col / 255
+    elif mode == BKGND_LIGHTEN:
+        new = numpy.maximum(old, col)
+    elif mode == BKGND_DARKEN:
+        new = numpy.minimum(old, col)
+    elif mode == BKGND_SCREEN:
+        new = 255 - (255 - old) * (255 - col) / 255
+    elif mode == BKGND_ADD:
+        new = old + col
+    elif mode == BKGND_ADDA:
+        new = old + alpha * col
+    elif mode == BKGND_BURN:
+        new = old + col - 255
+    elif mode == BKGND_ALPH:
+        new = old + alpha * (col - old)
+    else:
+        new = old * 0 + col
+    return numpy.clip(new, 0, 255).astype(numpy.uint8)
+
+def _headless_blit(src, x, y, w, h, dst, xdst, ydst, ffade, bfade):
+    if w == 0:
+        w = src.width
+    if h == 0:
+        h = src.height
+    # clip the rectangle to both consoles
+    (x1, y1) = (max(x, 0, x - xdst), max(y, 0, y - ydst))
+    (x2, y2) = (min(x + w, src.width, dst.width - xdst + x), min(y + h, src.height, dst.height - ydst + y))
+    if x2 <= x1 or y2 <= y1:
+        return
+    s = (slice(y1, y2), slice(x1, x2))
+    d = (slice(y1 - y + ydst, y2 - y + ydst), slice(x1 - x + xdst, x2 - x + xdst))
+    if ffade == 1.0 and bfade == 1.0:
+        dst.char[d] = src.char[s]
+        dst.fore[d] = src.fore[s]
+        dst.back[d] = src.back[s]
+        return
+
+    # faded blit, the way libtcod mixes the two consoles
+    def lerp(a, b, coef):
+        return (a + (b.astype(numpy.float32) - a) * coef).astype(numpy.uint8)
+    (schar, sfore, sback) = (src.char[s], src.fore[s], src.back[s])
+    (dchar, dfore, dback) = (dst.char[d], dst.fore[d], dst.back[d])
+    space = (schar == ord(' '))[..., None]
+    onto_space = (dchar == ord(' '))[..., None]
+    same = (dchar == schar)[..., None]
+    if ffade < 0.5:
+        other_fore = lerp(dfore, dback, ffade * 2)
+    else:
+        other_fore = lerp(dback, sfore, (ffade - 0.5) * 2)
+    fore = numpy.where(space, lerp(dfore, sback, bfade),
+        numpy.where(onto_space, lerp(dback, sfore, ffade),
+        numpy.where(same, lerp(dfore, sfore, ffade), other_fore)))
+    take_char = ~space[..., 0] & (onto_space[..., 0] | (ffade >= 0.5))
+    dst.char[d] = numpy.where(take_char, schar, dchar)
+    dst.fore[d] = fore
+    dst.back[d] = lerp(dback, sback, bfade)
+
+def console_get_frame():
+    # headless backend: (char, fore, back) arrays of the root console as it
+    # was at the last console_flush, or None before the first one
+    return _headless_frame
+
+def console_get_frame_text():
+    # headless backend: the characters of the last flushed frame, one string
+    # per row
+    if _headless_frame is None:
+        return None
+    return [''.join(chr(c) for c in row) for row in _headless_frame[0].tolist()]
+
+class _HeadlessImage(object):
+    # image of the headless backend, which doesn't decode the file
+    def __init__(self, filename):
+        self.filename = filename
+
 ############################
 # sys module
 ############################
@@ -977,9 +1468,16 @@ _lib.TCOD_sys_elapsed_seconds.restype = c_float
 
 # high precision time functions
 def sys_set_fps(fps):
+    global _headless_fps
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        # never waits, the limit is only remembered
+        _headless_fps = fps
+        return
     _lib.TCOD_sys_set_fps(fps)
 
 def sys_get_fps():
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _headless_fps
     return _lib.TCOD_sys_get_fps()
 
 def sys_get_last_frame_length():
@@ -1032,6 +1530,7 @@ def sys_register_SDL_renderer(callback):
     _lib.TCOD_sys_register_SDL_renderer(sdl_renderer_func)
 
 # events
+EVENT_NONE=0
 EVENT_KEY_PRESS=1
 EVENT_KEY_RELEASE=2
 EVENT_KEY=EVENT_KEY_PRESS|EVENT_KEY_RELEASE
@@ -1041,11 +1540,60 @@ EVENT_MOUSE_RELEASE=16
 EVENT_MOUSE=EVENT_MOUSE_MOVE|EVENT_MOUSE_PRESS|EVENT_MOUSE_RELEASE
 EVENT_ANY=EVENT_KEY|EVENT_MOUSE
 def sys_check_for_event(mask,k,m) :
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _headless_next_event(mask, k, m)
     return _lib.TCOD_sys_check_for_event(c_int(mask),byref(k),byref(m))
 
 def sys_wait_for_event(mask,k,m,flush) :
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _headless_wait_for_event(mask, k, m)
     return _lib.TCOD_sys_wait_for_event(c_int(mask),byref(k),byref(m),c_bool(flush))
 
+# headless backend input: every check for an event takes the next one queued
+# with sys_push_event, e.g. sys_push_event(EVENT_KEY_PRESS, key=Key(KEY_CHAR,
+# ord('g'), True)). an EVENT_NONE entry makes one check find nothing, and
+# once the queue runs out the window counts as closed.
+_headless_events = collections.deque()
+_headless_mouse = None
+
+def sys_push_event(event, key=None, mouse=None):
+    _headless_events.append((event, key, mouse))
+
+def sys_clear_events():
+    _headless_events.clear()
+
+def _headless_next_event(mask, k, m):
+    global _headless_closed, _headless_mouse
+    if _headless_events:
+        (event, key, mouse) = _headless_events.popleft()
+        if not event & mask:
+            event = EVENT_NONE
+    else:
+        _headless_closed = True
+        (event, key, mouse) = (EVENT_NONE, None, None)
+
+    if k is not None:
+        if not (event & EVENT_KEY and key is not None):
+            key = Key()
+        memmove(byref(k), byref(key), sizeof(Key))
+    if m is not None:
+        if event & EVENT_MOUSE and mouse is not None:
+            _headless_mouse = mouse
+        if _headless_mouse is not None:
+            memmove(byref(m), byref(_headless_mouse), sizeof(Mouse))
+        if not event & EVENT_MOUSE:
+            # the mouse stays where it was, but nothing happened
+            (m.dx, m.dy, m.dcx, m.dcy) = (0, 0, 0, 0)
+            (m.lbutton_pressed, m.rbutton_pressed, m.mbutton_pressed) = (False, False, False)
+            (m.wheel_up, m.wheel_down) = (False, False)
+    return event
+
+def _headless_wait_for_event(mask, k, m):
+    while True:
+        event = _headless_next_event(mask, k, m)
+        if event != EVENT_NONE or _headless_closed:
+            return event
+
 ############################
 # line module
 ############################
@@ -1117,6 +1665,8 @@ def image_is_pixel_transparent(image,x,y) :
     return _lib.TCOD_image_is_pixel_transparent(image,c_int(x),c_int(y))
 
 def image_load(filename):
+    if _console_backend == CONSOLE_BACKEND_HEADLESS:
+        return _HeadlessImage(filename)
     return _lib.TCOD_image_load(c_char_p(filename))
 
 def image_from_console(console):
@@ -1142,19 +1692,27 @@ def image_put_pixel(image, x, y, col):
     ##_lib.TCOD_image_put_pixel_wrapper(image, x, y, col)
 
 def image_blit(image, console, x, y, bkgnd_flag, scalex, scaley, angle):
+    if isinstance(image, _HeadlessImage):
+        return
     _lib.TCOD_image_blit(image, console, c_float(x), c_float(y), bkgnd_flag,
                          c_float(scalex), c_float(scaley), c_float(angle))
 
 def image_blit_rect(image, console, x, y, w, h, bkgnd_flag):
+    if isinstance(image, _HeadlessImage):
+        return
     _lib.TCOD_image_blit_rect(image, console, x, y, w, h, bkgnd_flag)
 
 def image_blit_2x(image, console, dx, dy, sx=0, sy=0, w=-1, h=-1):
+    if isinstance(image, _HeadlessImage):
+        return
     _lib.TCOD_image_blit_2x(image, console, dx,dy,sx,sy,w,h)
 
 def image_save(image, filename):
     _lib.TCOD_image_save(image, c_char_p(filename))
 
 def image_delete(image):
+    if isinstance(image, _HeadlessImage):
+        return
     _lib.TCOD_image_delete(image)
 
 ############################
@@ -1403,25 +1961,58 @@ DISTRIBUTION_GAUSSIAN_RANGE = 2
 DISTRIBUTION_GAUSSIAN_INVERSE = 3
 DISTRIBUTION_GAUSSIAN_RANGE_INVERSE = 4
 
+# without the native library, generators are python random.Random objects
+# (0 is the default one). they give other sequences than libtcod's, and only
+# the linear distribution.
+class _PyRandom(random.Random):
+    pass
+
+_py_default_random = _PyRandom()
+
+def _py_random(rnd):
+    # the python generator rnd stands for, or None for a native one
+    if isinstance(rnd, _PyRandom):
+        return rnd
+    if not rnd and not LIB_LOADED:
+        return _py_default_random
+    return None
+
 def random_get_instance():
+    if not LIB_LOADED:
+        return _py_default_random
     return _lib.TCOD_random_get_instance()
 
 def random_new(algo=RNG_CMWC):
+    if not LIB_LOADED:
+        return _PyRandom()
     return _lib.TCOD_random_new(algo)
 
 def random_new_from_seed(seed, algo=RNG_CMWC):
+    if not LIB_LOADED:
+        return _PyRandom(seed)
     return _lib.TCOD_random_new_from_seed(algo,c_uint(seed))
 
 def random_set_distribution(rnd, dist) :
+	if _py_random(rnd) is not None:
+		return
 	_lib.TCOD_random_set_distribution(rnd, dist)
 
 def random_get_int(rnd, mi, ma):
+    r = _py_random(rnd)
+    if r is not None:
+        return r.randint(min(mi, ma), max(mi, ma))
     return _lib.TCOD_random_get_int(rnd, mi, ma)
 
 def random_get_float(rnd, mi, ma):
+    r = _py_random(rnd)
+    if r is not None:
+        return r.uniform(mi, ma)
     return _lib.TCOD_random_get_float(rnd, c_float(mi), c_float(ma))
 
 def random_get_double(rnd, mi, ma):
+    r = _py_random(rnd)
+    if r is not None:
+        return r.uniform(mi, ma)
     return _lib.TCOD_random_get_double(rnd, c_double(mi), c_double(ma))
 
 def random_get_int_mean(rnd, mi, ma, mean):
@@ -1434,12 +2025,23 @@ def random_get_double_mean(rnd, mi, ma, mean):
     return _lib.TCOD_random_get_double_mean(rnd, c_double(mi), c_double(ma), c_double(mean))
 
 def random_save(rnd):
+    r = _py_random(rnd)
+    if r is not None:
+        backup = _PyRandom()
+        backup.setstate(r.getstate())
+        return backup
     return _lib.TCOD_random_save(rnd)
 
 def random_restore(rnd, backup):
+    r = _py_random(rnd)
+    if r is not None:
+        r.setstate(backup.getstate())
+        return
     _lib.TCOD_random_restore(rnd, backup)
 
 def random_delete(rnd):
+    if _py_random(rnd) is not None:
+        return
     _lib.TCOD_random_delete(rnd)
 
 ############################
@@ -1510,37 +2112,389 @@ NB_FOV_ALGORITHMS = 13
 def FOV_PERMISSIVE(p) :
     return FOV_PERMISSIVE_0+p
 
+# fov backends: the native library, or a pure python one working on numpy
+# arrays, which implements FOV_BASIC and FOV_SHADOW (the other algorithms
+# use FOV_SHADOW). a map remembers the backend that created it, so the
+# backend can be switched at any time, but is normally chosen at startup.
+FOV_BACKEND_C = 'c'
+FOV_BACKEND_PYTHON = 'python'
+
+def map_set_backend(backend):
+    global _fov_backend
+    if backend not in (FOV_BACKEND_C, FOV_BACKEND_PYTHON):
+        raise ValueError('Unknown fov backend %r.' % (backend,))
+    if backend == FOV_BACKEND_C and not LIB_LOADED:
+        raise RuntimeError('The c fov backend needs the native libtcod library.')
+    if backend == FOV_BACKEND_PYTHON and not numpy_available:
+        raise RuntimeError('The python fov backend needs numpy.')
+    _fov_backend = backend
+
+def map_get_backend():
+    return _fov_backend
+
+# default to $LIBTCOD_FOV_BACKEND, or to the native library if it loaded
+if os.environ.get('LIBTCOD_FOV_BACKEND'):
+    map_set_backend(os.environ['LIBTCOD_FOV_BACKEND'])
+elif LIB_LOADED or not numpy_available:
+    _fov_backend = FOV_BACKEND_C
+else:
+    _fov_backend = FOV_BACKEND_PYTHON
+
+class _PyMap(object):
+    # map of the python fov backend. the flags are numpy bool arrays shaped
+    # (height, width), like the result of map_get_fov.
+    def __init__(self, w, h):
+        self.width = w
+        self.height = h
+        self.transparent = numpy.zeros((h, w), dtype=bool)
+        self.walkable = numpy.zeros((h, w), dtype=bool)
+        self.fov = numpy.zeros((h, w), dtype=bool)
+
+_py_line_cache = {}
+
+def _py_line(dx, dy):
+    # offsets of the cells following the origin on the line to (dx, dy).
+    # steps exactly like TCOD_line_step, so rays cross the same cells as in
+    # the native library. lines only depend on the offset, so they're cached.
+    line = _py_line_cache.get((dx, dy))
+    if line is None:
+        stepx = (dx > 0) - (dx < 0)
+        stepy = (dy > 0) - (dy < 0)
+        x = y = 0
+        line = []
+        if stepx * dx > stepy * dy:
+            e = stepx * dx
+            while x != dx:
+                x += stepx
+                e -= 2 * stepy * dy
+                if e < 0:
+                    y += stepy
+                    e += 2 * stepx * dx
+                line.append((x, y))
+        else:
+            e = stepy * dy
+            while y != dy:
+                y += stepy
+                e -= 2 * stepx * dx
+                if e < 0:
+                    x += stepx
+                    e += 2 * stepy * dy
+                line.append((x, y))
+        _py_line_cache[(dx, dy)] = line
+    return line
+
+def _py_cast_ray(fov, transparent, w, h, xo, yo, xd, yd, r2, light_walls):
+    blocked = False
+    for dx, dy in _py_line(xd - xo, yd - yo):
+        if r2 > 0 and dx * dx + dy * dy > r2:
+            return
+        x = xo + dx
+        y = yo + dy
+        if x < 0 or y < 0 or x >= w or y >= h:
+            return # ray out of map
+        if not blocked and not transparent[y][x]:
+            blocked = True
+        elif blocked:
+            return # wall
+        if light_walls or not blocked:
+            fov[y][x] = True
+
+def _py_postproc(fov, transparent, x0, y0, x1, y1, dx, dy):
+    # light the walls next to lit floor cells that no ray reached
+    for cx in range(x0, x1 + 1):
+        for cy in range(y0, y1 + 1):
+            if fov[cy][cx] and transparent[cy][cx]:
+                x2 = cx + dx
+                y2 = cy + dy
+                if x0 <= x2 <= x1 and not transparent[cy][x2]:
+                    fov[cy][x2] = True
+                if y0 <= y2 <= y1 and not transparent[y2][cx]:
+                    fov[y2][cx] = True
+                if x0 <= x2 <= x1 and y0 <= y2 <= y1 and not transparent[y2][x2]:
+                    fov[y2][x2] = True
+
+def _py_fov_basic(fov, transparent, w, h, px, py, radius, light_walls):
+    # ray casting towards every cell on the border of the fov area
+    xmin, ymin, xmax, ymax = 0, 0, w, h
+    if radius > 0:
+        xmin = max(0, px - radius)
+        ymin = max(0, py - radius)
+        xmax = min(w, px + radius + 1)
+        ymax = min(h, py + radius + 1)
+    r2 = radius * radius
+    fov[py][px] = True
+    for xo in range(xmin, xmax):
+        _py_cast_ray(fov, transparent, w, h, px, py, xo, ymin, r2, light_walls)
+    for yo in range(ymin + 1, ymax):
+        _py_cast_ray(fov, transparent, w, h, px, py, xmax - 1, yo, r2, light_walls)
+    for xo in range(xmax - 2, -1, -1):
+        _py_cast_ray(fov, transparent, w, h, px, py, xo, ymax - 1, r2, light_walls)
+    for yo in range(ymax - 2, 0, -1):
+        _py_cast_ray(fov, transparent, w, h, px, py, xmin, yo, r2, light_walls)
+    if light_walls:
+        _py_postproc(fov, transparent, xmin, ymin, px, py, -1, -1)
+        _py_postproc(fov, transparent, px, ymin, xmax - 1, py, 1, -1)
+        _py_postproc(fov, transparent, xmin, py, px, ymax - 1, -1, 1)
+        _py_postproc(fov, transparent, px, py, xmax - 1, ymax - 1, 1, 1)
+
+# octant transforms for recursive shadowcasting
+_SHADOW_MULT = ((1, 0, 0, -1, -1, 0, 0, 1),
+                (0, 1, -1, 0, 0, -1, 1, 0),
+                (0, 1, 1, 0, 0, -1, -1, 0),
+                (1, 0, 0, 1, -1, 0, 0, -1))
+
+def _py_cast_light(fov, transparent, w, h, cx, cy, row, start, end, radius, r2,
+                   xx, xy, yx, yy, light_walls):
+    if start < end:
+        return
+    new_start = 0.0
+    for j in range(row, radius + 1):
+        dx = -j - 1
+        dy = -j
+        blocked = False
+        while dx <= 0:
+            dx += 1
+            x = cx + dx * xx + dy * xy
+            y = cy + dx * yx + dy * yy
+            if x < 0 or y < 0 or x >= w or y >= h:
+                continue
+            l_slope = (dx - 0.5) / (dy + 0.5)
+            r_slope = (dx + 0.5) / (dy - 0.5)
+            if start < r_slope:
+                continue
+            elif end > l_slope:
+                break
+            if dx * dx + dy * dy <= r2 and (light_walls or transparent[y][x]):
+                fov[y][x] = True
+            if blocked:
+                if not transparent[y][x]:
+                    new_start = r_slope
+                    continue
+                else:
+                    blocked = False
+                    start = new_start
+            elif not transparent[y][x] and j < radius:
+                blocked = True
+                _py_cast_light(fov, transparent, w, h, cx, cy, j + 1, start, l_slope,
+                               radius, r2, xx, xy, yx, yy, light_walls)
+                new_start = r_slope
+        if blocked:
+            break
+
+def _py_fov_shadow(fov, transparent, w, h, px, py, radius, light_walls):
+    if radius == 0:
+        # no limit: reach the farthest corner of the map
+        rx = max(w - px, px)
+        ry = max(h - py, py)
+        radius = int(math.sqrt(rx * rx + ry * ry)) + 1
+    r2 = radius * radius
+    for oct in range(8):
+        _py_cast_light(fov, transparent, w, h, px, py, 1, 1.0, 0.0, radius, r2,
+                       _SHADOW_MULT[0][oct], _SHADOW_MULT[1][oct],
+                       _SHADOW_MULT[2][oct], _SHADOW_MULT[3][oct], light_walls)
+    fov[py][px] = True
+
+def _py_map_compute_fov(m, x, y, radius, light_walls, algo):
+    # the algorithms walk the map cell by cell, which is much faster on
+    # python lists than on numpy scalars: convert once, write back once
+    transparent = m.transparent.tolist()
+    fov = [[False] * m.width for i in range(m.height)]
+    if 0 <= x < m.width and 0 <= y < m.height:
+        if algo == FOV_BASIC:
+            _py_fov_basic(fov, transparent, m.width, m.height, x, y, radius, light_walls)
+        else:
+            _py_fov_shadow(fov, transparent, m.width, m.height, x, y, radius, light_walls)
+    m.fov[...] = fov
+
 def map_new(w, h):
+    if _fov_backend == FOV_BACKEND_PYTHON:
+        return _PyMap(w, h)
     return _lib.TCOD_map_new(w, h)
 
 def map_copy(source, dest):
+    if isinstance(source, _PyMap) and isinstance(dest, _PyMap):
+        dest.width = source.width
+        dest.height = source.height
+        dest.transparent = source.transparent.copy()
+        dest.walkable = source.walkable.copy()
+        dest.fov = source.fov.copy()
+        return
+    if isinstance(source, _PyMap) or isinstance(dest, _PyMap):
+        raise TypeError('map_copy: both maps must come from the same fov backend.')
     return _lib.TCOD_map_copy(source, dest)
 
 def map_set_properties(m, x, y, isTrans, isWalk):
+    if isinstance(m, _PyMap):
+        m.transparent[y, x] = isTrans
+        m.walkable[y, x] = isWalk
+        return
     _lib.TCOD_map_set_properties(m, x, y, c_int(isTrans), c_int(isWalk))
 
+# layout of a TCOD_map_t, used to fill its cells without one call per cell
+class _CMap(Structure):
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('nbcells', c_int),
+              ('cells', POINTER(c_uint8)),
+              ]
+
+_map_cell_layout = None
+
+def _map_get_cell_layout():
+    # find out how this build of the library packs a map cell, by setting
+    # known properties through the regular API and reading the raw memory
+    # back. returns None if the layout isn't one we know how to write.
+    global _map_cell_layout
+    if _map_cell_layout is not None:
+        return _map_cell_layout or None
+    _map_cell_layout = False
+    m = _lib.TCOD_map_new(9, 1)
+    try:
+        cmap = cast(m, POINTER(_CMap)).contents
+        if (cmap.width, cmap.height, cmap.nbcells) != (9, 1, 9):
+            return None
+        # a transparent cell in fov, then a wall hiding a walkable cell
+        _lib.TCOD_map_set_properties(m, 0, 0, 1, 0)
+        _lib.TCOD_map_set_properties(m, 2, 0, 0, 1)
+        _lib.TCOD_map_compute_fov(m, 0, 0, 0, c_bool(True), FOV_BASIC)
+        raw = bytearray(string_at(cmap.cells, 9))
+        if raw[0] == 1 | 4 and raw[2] == 2:
+            # one byte per cell: transparent, walkable and fov bit flags
+            _map_cell_layout = 'bits'
+        elif raw[0:3] == bytearray([1, 0, 1]) and raw[6:9] == bytearray([0, 1, 0]):
+            # one bool per field: transparent, walkable, fov
+            _map_cell_layout = 'bools'
+    finally:
+        _lib.TCOD_map_delete(m)
+    return _map_cell_layout or None
+
+def _flags_buffer(values, n):
+    # normalize a numpy array, bytes buffer or sequence of flags into a
+    # numpy uint8 array (or a bytearray without numpy) of n zeros and ones
+    if numpy_available:
+        if isinstance(values, (bytes, bytearray)):
+            flags = numpy.frombuffer(bytes(values), dtype=numpy.uint8)
+        else:
+            flags = numpy.asarray(values)
+        flags = (flags.reshape(-1) != 0).astype(numpy.uint8)
+    else:
+        if isinstance(values, (bytes, bytearray)):
+            values = bytearray(values)
+        flags = bytearray(1 if v else 0 for v in values)
+    if len(flags) != n:
+        raise ValueError('map_set_properties_bulk: expected %d cells, got %d.' % (n, len(flags)))
+    return flags
+
+def map_set_properties_bulk(m, transparent, walkable):
+    # set the properties of every cell of the map in one go. transparent and
+    # walkable hold width*height flags in row-major order (x + y * width):
+    # numpy arrays (2D arrays shaped (height, width)), bytes buffers or any
+    # sequence of truth values. the fov state of the cells is reset.
+    w = map_get_width(m)
+    h = map_get_height(m)
+    n = w * h
+    trans = _flags_buffer(transparent, n)
+    walk = _flags_buffer(walkable, n)
+    if isinstance(m, _PyMap):
+        m.transparent[...] = trans.reshape(h, w)
+        m.walkable[...] = walk.reshape(h, w)
+        m.fov[...] = False
+        return
+    layout = _map_get_cell_layout()
+    if layout == 'bits':
+        if numpy_available:
+            cells = (trans | (walk << 1)).tobytes()
+        else:
+            cells = bytes(bytearray(t | (k << 1) for t, k in zip(trans, walk)))
+    elif layout == 'bools':
+        if numpy_available:
+            cells = numpy.zeros((n, 3), dtype=numpy.uint8)
+            cells[:, 0] = trans
+            cells[:, 1] = walk
+            cells = cells.tobytes()
+        else:
+            cells = bytearray(3 * n)
+            cells[0::3] = trans
+            cells[1::3] = walk
+            cells = bytes(cells)
+    else:
+        # unknown cell layout, fall back on the slow path
+        for i in range(n):
+            _lib.TCOD_map_set_properties(m, i % w, i // w, trans[i], walk[i])
+        return
+    cmap = cast(m, POINTER(_CMap)).contents
+    memmove(cmap.cells, cells, len(cells))
+
 def map_clear(m,walkable=False,transparent=False):
+    if isinstance(m, _PyMap):
+        # same argument order as the native TCOD_map_clear call below
+        m.transparent[...] = walkable
+        m.walkable[...] = transparent
+        m.fov[...] = False
+        return
     _lib.TCOD_map_clear(m,c_int(walkable),c_int(transparent))
 
 def map_compute_fov(m, x, y, radius=0, light_walls=True, algo=FOV_RESTRICTIVE ):
+    if isinstance(m, _PyMap):
+        _py_map_compute_fov(m, x, y, radius, light_walls, algo)
+        return
     _lib.TCOD_map_compute_fov(m, x, y, c_int(radius), c_bool(light_walls), c_int(algo))
 
 def map_is_in_fov(m, x, y):
+    if isinstance(m, _PyMap):
+        return 0 <= x < m.width and 0 <= y < m.height and bool(m.fov[y, x])
     return _lib.TCOD_map_is_in_fov(m, x, y)
 
+def map_get_fov(m):
+    # read the fov flags of every cell, as computed by the last
+    # map_compute_fov call, in one go. returns a numpy bool array shaped
+    # (height, width), or without numpy a bytearray of width*height zeros
+    # and ones in row-major order (x + y * width).
+    if isinstance(m, _PyMap):
+        return m.fov.copy()
+    w = map_get_width(m)
+    h = map_get_height(m)
+    n = w * h
+    layout = _map_get_cell_layout()
+    if layout == 'bits':
+        raw = string_at(cast(m, POINTER(_CMap)).contents.cells, n)
+        if numpy_available:
+            return (numpy.frombuffer(raw, dtype=numpy.uint8) & 4).astype(bool).reshape(h, w)
+        return bytearray((c >> 2) & 1 for c in bytearray(raw))
+    elif layout == 'bools':
+        raw = string_at(cast(m, POINTER(_CMap)).contents.cells, 3 * n)
+        if numpy_available:
+            return numpy.frombuffer(raw, dtype=numpy.uint8)[2::3].astype(bool).reshape(h, w)
+        return bytearray(raw[2::3])
+    # unknown cell layout, fall back on the slow path
+    fov = bytearray(1 if _lib.TCOD_map_is_in_fov(m, i % w, i // w) else 0 for i in range(n))
+    if numpy_available:
+        return numpy.frombuffer(bytes(fov), dtype=numpy.uint8).astype(bool).reshape(h, w)
+    return fov
+
 def map_is_transparent(m, x, y):
+    if isinstance(m, _PyMap):
+        return 0 <= x < m.width and 0 <= y < m.height and bool(m.transparent[y, x])
     return _lib.TCOD_map_is_transparent(m, x, y)
 
 def map_is_walkable(m, x, y):
+    if isinstance(m, _PyMap):
+        return 0 <= x < m.width and 0 <= y < m.height and bool(m.walkable[y, x])
     return _lib.TCOD_map_is_walkable(m, x, y)
 
 def map_delete(m):
+    if isinstance(m, _PyMap):
+        return
     return _lib.TCOD_map_delete(m)
 
 def map_get_width(map):
+    if isinstance(map, _PyMap):
+        return map.width
     return _lib.TCOD_map_get_width(map)
 
 def map_get_height(map):
+    if isinstance(map, _PyMap):
+        return map.height
     return _lib.TCOD_map_get_height(map)
 
 ############################
@@ -1552,45 +2506,157 @@ _lib.TCOD_path_walk.restype = c_bool
 
 PATH_CBK_FUNC = CFUNCTYPE(c_float, c_int, c_int, c_int, c_int, py_object)
 
+# paths on maps of the python fov backend are computed in python too: an A*
+# searched from the destination to the origin, like libtcod's, over the
+# map's walkable flags (or, without the native library, over the costs a
+# path function gives). the cells left to walk are kept destination first.
+class _PyPath(object):
+    def __init__(self, m, dcost, func=None, userdata=0, w=0, h=0):
+        self.map = m
+        self.dcost = dcost
+        (self.func, self.userdata) = (func, userdata)
+        (self.width, self.height) = (m.width, m.height) if m is not None else (w, h)
+        (self.ox, self.oy, self.dx, self.dy) = (0, 0, 0, 0)
+        self.cells = []
+
+def _py_path_cost(p, walkable, x, y, nx, ny):
+    # the cost of a step between neighbouring cells, 0 if it can't be taken
+    if p.func is not None:
+        return p.func(x, y, nx, ny, p.userdata)
+    return 1.0 if walkable[ny][nx] else 0.0
+
+_PY_PATH_DIRS = [(0, -1), (-1, 0), (1, 0), (0, 1), (-1, -1), (1, -1), (-1, 1), (1, 1)]
+
+def _py_path_compute(p, ox, oy, dx, dy):
+    (p.ox, p.oy, p.dx, p.dy) = (ox, oy, dx, dy)
+    p.cells = []
+    if (ox, oy) == (dx, dy):
+        return True
+    (w, h) = (p.width, p.height)
+    if not (0 <= ox < w and 0 <= oy < h and 0 <= dx < w and 0 <= dy < h):
+        return False
+    walkable = p.map.walkable.tolist() if p.map is not None else None
+    if walkable is not None and not walkable[dy][dx]:
+        return False
+
+    costs = [(sx, sy, p.dcost if sx and sy else 1.0) for (sx, sy) in _PY_PATH_DIRS]
+    # octile distance to the origin (a plain lower bound if diagonals are cheap)
+    diag = min(p.dcost, 2.0)
+    def estimate(x, y):
+        (a, b) = (abs(x - ox), abs(y - oy))
+        if diag >= 1.0:
+            return max(a, b) + (diag - 1.0) * min(a, b)
+        return diag * max(a, b)
+
+    best = {(dx, dy): 0.0}
+    came_from = {}
+    heap = [(estimate(dx, dy), 0.0, dx, dy)]
+    while heap:
+        (f, g, x, y) = heapq.heappop(heap)
+        if (x, y) == (ox, oy):
+            break
+        if g > best[(x, y)]:
+            continue
+        for (sx, sy, cost) in costs:
+            (nx, ny) = (x + sx, y + sy)
+            if 0 <= nx < w and 0 <= ny < h:
+                step = _py_path_cost(p, walkable, x, y, nx, ny)
+                if not step:
+                    continue
+                ng = g + cost * step
+                if ng < best.get((nx, ny), ng + 1.0):
+                    best[(nx, ny)] = ng
+                    came_from[(nx, ny)] = (x, y)
+                    heapq.heappush(heap, (ng + estimate(nx, ny), ng, nx, ny))
+    else:
+        return False
+
+    # follow the search back from the origin to the destination
+    cell = (ox, oy)
+    while cell != (dx, dy):
+        cell = came_from[cell]
+        p.cells.append(cell)
+    p.cells.reverse()
+    return True
+
+def _py_path_walk(p, recompute):
+    if not p.cells:
+        return None, None
+    (x, y) = p.cells[-1]
+    if not _py_path_cost(p, p.map.walkable if p.map is not None else None, p.ox, p.oy, x, y):
+        # blocked since the path was computed
+        if not recompute or not _py_path_compute(p, p.ox, p.oy, p.dx, p.dy):
+            return None, None
+        return _py_path_walk(p, True)
+    p.cells.pop()
+    (p.ox, p.oy) = (x, y)
+    return x, y
+
+def _py_path_reverse(p):
+    # the way back: every cell but the destination, then the origin
+    back = [(p.ox, p.oy)] + p.cells[::-1][:-1] if p.cells else []
+    (p.ox, p.oy, p.dx, p.dy) = (p.dx, p.dy, p.ox, p.oy)
+    p.cells = back
+
 def path_new_using_map(m, dcost=1.41):
+    if isinstance(m, _PyMap):
+        return (_PyPath(m, dcost), None)
     return (_lib.TCOD_path_new_using_map(c_void_p(m), c_float(dcost)), None)
 
 def path_new_using_function(w, h, func, userdata=0, dcost=1.41):
+    if isinstance(_lib, _MissingLibrary):
+        return (_PyPath(None, dcost, func, userdata, w, h), None)
     cbk_func = PATH_CBK_FUNC(func)
     return (_lib.TCOD_path_new_using_function(w, h, cbk_func,
             py_object(userdata), c_float(dcost)), cbk_func)
 
 def path_compute(p, ox, oy, dx, dy):
+    if isinstance(p[0], _PyPath):
+        return _py_path_compute(p[0], ox, oy, dx, dy)
     return _lib.TCOD_path_compute(p[0], ox, oy, dx, dy)
 
 def path_get_origin(p):
+    if isinstance(p[0], _PyPath):
+        return p[0].ox, p[0].oy
     x = c_int()
     y = c_int()
     _lib.TCOD_path_get_origin(p[0], byref(x), byref(y))
     return x.value, y.value
 
 def path_get_destination(p):
+    if isinstance(p[0], _PyPath):
+        return p[0].dx, p[0].dy
     x = c_int()
     y = c_int()
     _lib.TCOD_path_get_destination(p[0], byref(x), byref(y))
     return x.value, y.value
 
 def path_size(p):
+    if isinstance(p[0], _PyPath):
+        return len(p[0].cells)
     return _lib.TCOD_path_size(p[0])
 
 def path_reverse(p):
+    if isinstance(p[0], _PyPath):
+        return _py_path_reverse(p[0])
     _lib.TCOD_path_reverse(p[0])  
 
 def path_get(p, idx):
+    if isinstance(p[0], _PyPath):
+        return p[0].cells[-1 - idx]
     x = c_int()
     y = c_int()
     _lib.TCOD_path_get(p[0], idx, byref(x), byref(y))
     return x.value, y.value
 
 def path_is_empty(p):
+    if isinstance(p[0], _PyPath):
+        return not p[0].cells
     return _lib.TCOD_path_is_empty(p[0])
 
 def path_walk(p, recompute):
+    if isinstance(p[0], _PyPath):
+        return _py_path_walk(p[0], recompute)
     x = c_int()
     y = c_int()
     if _lib.TCOD_path_walk(p[0], byref(x), byref(y), c_int(recompute)):
@@ -1598,6 +2664,8 @@ def path_walk(p, recompute):
     return None,None
 
 def path_delete(p):
+    if isinstance(p[0], _PyPath):
+        return
     _lib.TCOD_path_delete(p[0])
 
 _lib.TCOD_dijkstra_path_set.restype = c_bool
@@ -1,8 +1,25 @@
 import libtcodpy as libtcod
 import math
 import textwrap
-import shelve
 import random
+import heapq
+import collections
+import os
+import struct
+import zlib
+import json
+import threading
+import atexit
+import time
+import tempfile
+import shutil
+import sys
+import numpy
+
+try:
+	import lzma #python 3 only
+except ImportError:
+	lzma = None
 
 ######################
 # STATIC INFORMATION #
@@ -24,11 +41,59 @@ MAP_HEIGHT = 50
 CAMERA_WIDTH = 80
 CAMERA_HEIGHT = 43
 
+#what a map cell on screen shows; only the cells whose look changed since the last frame are redrawn
+CELL_UNEXPLORED = 0
+CELL_DARK_WALL = 1
+CELL_DARK_GROUND = 2
+CELL_LIGHT_WALL = 3
+CELL_LIGHT_GROUND = 4
+
 #parameters for dungeon generator
 ROOM_MAX_SIZE = 30
 ROOM_MIN_SIZE = 3
 MAX_ROOMS = 50
 
+#level generator: 'rooms' (the classic one, rooms at random spots), 'bsp' (binary space partition:
+#the map is cut in two again and again, down to leaves of BSP_LEAF_SIZE or less, each holding a room)
+#or 'cave' (every level a cave). --generator NAME picks one when starting the game
+MAP_GENERATOR = 'rooms'
+MAP_GENERATORS = ('rooms', 'bsp', 'cave')
+BSP_LEAF_SIZE = 20
+BSP_MIN_SIZE = ROOM_MIN_SIZE + 5
+
+#cave levels: noise with this share of walls, smoothed by a few cellular automaton passes. objects are
+#placed like in a room for every CAVE_ZONE x CAVE_ZONE square
+CAVE_WALL_CHANCE = 0.45
+CAVE_PASSES = 4
+CAVE_START_TRIES = 3
+CAVE_ZONE = 16
+
+#save files: a header and table of contents, then sections of packed tile layers and entity records,
+#each compressed with SAVE_COMPRESSION ('zlib', 'lzma' where there is the module, or None)
+SAVE_FILE = 'savegame.sav'
+SAVE_FORMAT_VERSION = 1
+SAVE_COMPRESSION = 'zlib'
+
+#saves are written by a background thread from a snapshot of the game, so play goes on meanwhile. at most
+#this many files wait to be written (a newer save of a file replaces the one waiting)
+SAVE_QUEUE_LIMIT = 8
+
+#between two full saves, a save only appends what changed since the last one to the journal. once the
+#journal is JOURNAL_LIMIT bytes, the next save writes the save file anew and starts a new journal
+SAVE_JOURNAL = 'savegame.journal'
+JOURNAL_LIMIT = 64 * 1024
+
+#the game is saved every AUTOSAVE_TURNS turns the player takes (None: only on the stairs and on leaving)
+AUTOSAVE_TURNS = 1
+
+#levels the player left are kept in a LevelStore: the most recently visited ones as they are, the others
+#written to a file each in this directory
+LEVELS_IN_MEMORY = 4
+LEVEL_DIRECTORY = 'savegame_levels'
+
+#the spawn tables of every dungeon level so far (see get_spawn_tables)
+spawn_tables = {}
+
 #nr of monsters that should generate
 #MAX_ROOM_MONSTERS = 3
 
@@ -39,6 +104,23 @@ FOV_ALGO = 0 #default FOV algorithm
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 13
 
+#FOV backend: 'c' (libtcod), 'python' (pure python/numpy, works without libtcod) or None to let libtcodpy pick
+FOV_BACKEND = None
+
+#master seed of new games, every level is generated from a seed derived from it (None picks one at random)
+GAME_SEED = None
+
+#where the input of this session is recorded (an InputLog, with --record FILE), and whether the game is
+#drawn at all (replays only need the game logic, see replay())
+input_log = None
+rendering = True
+
+#the generator of the combat and AI rolls of the game being played (see start_random)
+combat_rng = None
+
+#the level being generated in a worker thread, as (depth, seed, worker, result) (see pregenerate_level)
+next_level_worker = None
+
 #player color
 color_player = libtcod.lighter_sepia
 
@@ -74,6 +156,24 @@ FIREBALL_RADIUS = 5
 DIG_RANGE = 6
 
 #ai stuff
+#time units a player turn takes; an actor of speed SPEED_NORMAL acts once a turn, twice as fast twice a turn
+TURN_LENGTH = 100
+SPEED_NORMAL = 100
+
+#monsters closer than this chase the player (further ones wander), following a distance field that
+#reaches twice as far so they can walk around walls
+CHASE_RADIUS = 7
+
+#actors further than this from the player sleep instead of taking turns. sleepers are kept in buckets of
+#ACTIVITY_REGION x ACTIVITY_REGION tiles and when the player comes near, the turns they slept through are made
+#up for in one go (a wandering monster walks up to CATCH_UP_STEPS tiles in some direction)
+ACTIVITY_RADIUS = 2 * CHASE_RADIUS
+ACTIVITY_REGION = 8
+CATCH_UP_STEPS = 6
+
+#a monster's path is planned again when its target has moved this far from where the path ends
+PATH_REPLAN_DISTANCE = 3
+
 CONFUSE_NUM_TURNS = 10
 CONFUSE_RANGE = 8
 
@@ -86,18 +186,154 @@ LEVEL_UP_FACTOR = 125
 # CLASSES #
 ###########
 
-class Tile:
-	#a tile of the map and its properties
-	def __init__ (self, blocked, block_sight = None):
-		self.blocked = blocked
-		
-		#all tiles start unexplored
-		self.explored = False
+#tile kinds, stored alongside the flags of every tile
+TILE_WALL = 0
+TILE_FLOOR = 1
+
+#layout of one tile in the map's structured array
+TILE_DTYPE = numpy.dtype([
+	('blocked', numpy.bool_),
+	('block_sight', numpy.bool_),
+	('explored', numpy.bool_),
+	('kind', numpy.uint8)])
+
+class TileGrid:
+	#all tiles of the map in one numpy structured array, indexed [x, y]
+	#map[x][y].blocked still works for old code, map.blocked (etc.) is a view of the whole layer
+	
+	#goes up every time tiles change, so things worked out from the map know when to redo it
+	version = 0
 	
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.tiles = numpy.zeros((width, height), dtype=TILE_DTYPE).view(numpy.recarray)
+		
+		#occupancy: the number of blocking objects on each tile, and whether a tile is blocked by the map
+		#or by an object. the level's ObjectRegistry keeps them up to date, so is_blocked() is one read
+		self.blockers = numpy.zeros((width, height), dtype=numpy.uint8)
+		self.occupied = numpy.ones((width, height), dtype=bool)
+		
+		#all tiles start as unexplored walls
+		self.set_tiles(0, 0, width, height, True)
+		
+	def __getitem__(self, x):
+		#a column of records; map[x][y] is a numpy.record writing through to the grid
+		return self.tiles[x]
+		
+	def __len__(self):
+		return self.width
+		
+	@property
+	def blocked(self):
+		return self.tiles.blocked
+		
+	@property
+	def block_sight(self):
+		return self.tiles.block_sight
+		
+	@property
+	def explored(self):
+		return self.tiles.explored
+		
+	@property
+	def kind(self):
+		return self.tiles.kind
+		
+	def set_tiles(self, x1, y1, x2, y2, blocked, block_sight=None, mask=None):
+		#set every tile in the box x1 <= x < x2, y1 <= y < y2 (optionally only where mask is True)
 		#by default, if a tile is blocked, it also blocks sight
 		if block_sight is None: block_sight = blocked
-		self.block_sight = block_sight
-
+		kind = TILE_WALL if blocked else TILE_FLOOR
+		
+		area = (slice(x1, x2), slice(y1, y2))
+		if mask is None:
+			self.tiles.blocked[area] = blocked
+			self.tiles.block_sight[area] = block_sight
+			self.tiles.kind[area] = kind
+		else:
+			self.tiles.blocked[area][mask] = blocked
+			self.tiles.block_sight[area][mask] = block_sight
+			self.tiles.kind[area][mask] = kind
+		self.occupied[area] = self.tiles.blocked[area] | (self.blockers[area] > 0)
+		self.version += 1
+		
+	def add_blocker(self, x, y):
+		self.blockers[x, y] += 1
+		self.occupied[x, y] = True
+		
+	def remove_blocker(self, x, y):
+		self.blockers[x, y] -= 1
+		if not self.blockers[x, y]:
+			self.occupied[x, y] = self.tiles.blocked[x, y]
+			
+	def clear_blockers(self):
+		self.blockers[...] = 0
+		self.occupied[...] = self.tiles.blocked
+		
+		
+class DistanceField:
+	#the number of steps (in 8 directions, around walls) from every tile up to radius steps away to (x, y),
+	#worked out one wavefront at a time over the box around it. tiles it doesn't reach are UNREACHABLE.
+	#a diagonal step only counts where a monster can take it: Object.move goes up or down first, so the
+	#tile straight up or down from where it starts must not be a wall
+	UNREACHABLE = 0xffff
+	
+	#orthogonal steps first, so they win ties
+	STEPS = [(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1)]
+	
+	def __init__(self, grid, x, y, radius):
+		self.grid = grid
+		self.version = grid.version
+		(self.x, self.y) = (x, y)
+		(self.x1, self.y1) = (max(x - radius, 0), max(y - radius, 0))
+		(x2, y2) = (min(x + radius + 1, grid.width), min(y + radius + 1, grid.height))
+		passable = ~grid.blocked[self.x1:x2, self.y1:y2]
+		
+		self.steps = numpy.empty(passable.shape, dtype=numpy.uint16)
+		self.steps[...] = self.UNREACHABLE
+		front = numpy.zeros(passable.shape, dtype=bool)
+		front[x - self.x1, y - self.y1] = True
+		self.steps[front] = 0
+		for step in range(1, radius + 1):
+			#grow the wavefront by a tile in every direction, keeping the new passable tiles: sideways first,
+			#then up and down from the passable tiles only (the last leg of a diagonal step, walked backwards)
+			wide = front.copy()
+			wide[1:, :] |= front[:-1, :]
+			wide[:-1, :] |= front[1:, :]
+			grown = wide.copy()
+			wide &= passable
+			grown[:, 1:] |= wide[:, :-1]
+			grown[:, :-1] |= wide[:, 1:]
+			front = grown & passable & (self.steps == self.UNREACHABLE)
+			if not front.any():
+				break
+			self.steps[front] = step
+			
+	def at(self, x, y):
+		(i, j) = (x - self.x1, y - self.y1)
+		if 0 <= i < self.steps.shape[0] and 0 <= j < self.steps.shape[1]:
+			return self.steps[i, j]
+		return self.UNREACHABLE
+		
+	def downhill(self, x, y):
+		#the step (dx, dy) onto the free neighbouring tile with the fewest steps left, or None if none is closer
+		#(or, from a corner of (x, y), onto a free tile beside it). a diagonal step also needs the tile straight
+		#up or down free, or Object.move would only go half of it
+		best = None
+		best_steps = self.at(x, y)
+		for (dx, dy) in self.STEPS:
+			steps = self.at(x + dx, y + dy)
+			if (steps < best_steps and not self.grid.occupied[x + dx, y + dy] and
+				not self.grid.occupied[x, y + dy]):
+				(best, best_steps) = ((dx, dy), steps)
+		if best is None and abs(x - self.x) == 1 and abs(y - self.y) == 1:
+			#diagonally next to (x, y), which is only reached (attacked) from the side: step beside it
+			for (dx, dy) in self.STEPS[:4]:
+				(side_x, side_y) = (x + dx, y + dy)
+				if abs(side_x - self.x) + abs(side_y - self.y) == 1 and not self.grid.occupied[side_x, side_y]:
+					return (dx, dy)
+		return best
 		
 class Rect:
 	#a rectangle on the map, used to characterize a room
@@ -121,7 +357,9 @@ class Rect:
 class Object:
 	#generic object (player, monsters, items etc)
 	#is always represented by a character on screen
-	def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, item=None, equipment=None):
+	speed = SPEED_NORMAL
+	
+	def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, item=None, equipment=None, speed=SPEED_NORMAL):
 		self.x = x
 		self.y = y
 		self.char = char
@@ -129,6 +367,10 @@ class Object:
 		self.name = name
 		self.blocks = blocks
 		self.always_visible = always_visible
+		self.speed = speed
+		
+		#tells this object apart from every other one of the game, given when it's first saved (see save_game)
+		self.serial = None
 		
 		# ! composition ! #
 		self.fighter = fighter
@@ -174,19 +416,17 @@ class Object:
 		#if not is_blocked(self.x + dx, self.y + dy): 
 		if self != player:
 			if not is_blocked(self.x, self.y + dy):
-				self.y += dy
+				objects.move(self, self.x, self.y + dy)
 			if not is_blocked(self.x + dx, self.y):
-				self.x += dx
+				objects.move(self, self.x + dx, self.y)
 		elif self == player:
 			if not is_blocked(self.x + dx, self.y + dy):
-				self.x += dx
-				self.y += dy
+				objects.move(self, self.x + dx, self.y + dy)
 		
 	def send_to_back(self):
 		#make this object be drawn first, so all other appear above it if they're in the same tile
 		global objects
-		objects.remove(self)
-		objects.insert(0, self)
+		objects.send_to_back(self)
 		
 	def distance_to(self, other):
 		#return the distance to another object
@@ -200,8 +440,8 @@ class Object:
 		
 	def draw(self):
 		#only show if it's visible to the player or: is set to always_visible and on an explored tile
-		if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or
-		(self.always_visible and map[self.x][self.y].explored)):
+		if (in_fov(self.x, self.y) or
+		(self.always_visible and map.explored[self.x, self.y])):
 			#do:
 			(x, y) = to_camera_coordinates(self.x, self.y) 
 			
@@ -209,17 +449,865 @@ class Object:
 				#set the color and then draw the character that represents this object
 				libtcod.console_set_default_foreground(con, self.color)
 				libtcod.console_put_char(con, x, y, self.char, libtcod.BKGND_NONE)
-	
-	def clear(self):
-		#erase the character that represents this object
-		(x, y) = to_camera_coordinates(self.x, self.y)
+			
+			
+class TurnScheduler:
+	#the objects with an ai on a level, in a heap by the time of their next action. an action takes
+	#TURN_LENGTH * SPEED_NORMAL / speed time units. removed objects and ones that lost their ai (died)
+	#are only dropped when they come up. actors further than ACTIVITY_RADIUS from the player fall
+	#asleep when their turn comes, until the player gets close to their region again
+	def __init__(self):
+		self.time = 0
+		self.heap = []
+		self.serial = 0
+		self.entries = {} #object -> serial of its live heap entry
+		self.regions = {} #(x, y) region -> {sleeping object: (time it fell asleep, serial)}
+		self.asleep = {} #sleeping object -> its region
+		
+	def add(self, obj, delay=0):
+		self.serial += 1
+		self.entries[obj] = self.serial
+		heapq.heappush(self.heap, (self.time + delay, self.serial, obj))
+		
+	def remove(self, obj):
+		self.entries.pop(obj, None)
+		region = self.asleep.pop(obj, None)
+		if region is not None:
+			del self.regions[region][obj]
+			
+	def sleep(self, obj):
+		del self.entries[obj]
+		region = (obj.x // ACTIVITY_REGION, obj.y // ACTIVITY_REGION)
+		self.serial += 1
+		self.regions.setdefault(region, {})[obj] = (self.time, self.serial)
+		self.asleep[obj] = region
+		
+	def wake(self, x, y):
+		#wake the sleepers near (x, y), catching up on the turns they missed. they wake in the order
+		#they fell asleep, not in the order of the dict (which would make replays differ)
+		r = ACTIVITY_RADIUS
+		for rx in range((x - r) // ACTIVITY_REGION, (x + r) // ACTIVITY_REGION + 1):
+			for ry in range((y - r) // ACTIVITY_REGION, (y + r) // ACTIVITY_REGION + 1):
+				sleepers = self.regions.get((rx, ry))
+				if not sleepers:
+					continue
+				for (obj, (since, serial)) in sorted(sleepers.items(), key=lambda item: item[1]):
+					if obj.distance(x, y) > r:
+						continue
+					del sleepers[obj]
+					del self.asleep[obj]
+					if not obj.ai:
+						continue
+					turns = int((self.time - since) * obj.speed / float(TURN_LENGTH * SPEED_NORMAL))
+					catch_up = getattr(obj.ai, 'catch_up', None)
+					if turns > 0 and catch_up is not None:
+						catch_up(turns)
+					self.add(obj)
+		
+	def advance(self, duration, center):
+		#let everyone near center whose time comes in the next duration units act, in order of time
+		self.wake(*center)
+		end = self.time + duration
+		while self.heap and self.heap[0][0] < end:
+			(self.time, serial, obj) = heapq.heappop(self.heap)
+			if self.entries.get(obj) != serial:
+				continue
+			if not obj.ai:
+				del self.entries[obj]
+				continue
+			if obj.distance(*center) > ACTIVITY_RADIUS:
+				self.sleep(obj)
+				continue
+			obj.ai.take_turn()
+			if self.entries.get(obj) == serial:
+				self.add(obj, TURN_LENGTH * float(SPEED_NORMAL) / obj.speed)
+		self.time = end
+		
+		
+class ObjectRegistry(list):
+	#the objects of the current level, in drawing order, plus an index of the objects on every tile
+	#so finding what is at (x, y) doesn't scan the whole level. positions must change through move()
+	#and the blocks flag through set_blocks(), which also keep the level map's occupancy up to date.
+	#the objects that act are also in the level's TurnScheduler
+	def __init__(self, objects=(), grid=None):
+		list.__init__(self, objects)
+		self.attach(grid)
+			
+	def __reduce__(self):
+		#pickle as a plain list of objects, the index is rebuilt when loading
+		return (ObjectRegistry, (list(self),))
+		
+	def attach(self, grid):
+		#(re)build the index, the occupancy of the given map and the scheduler
+		self.grid = grid
+		self.tiles = {}
+		self.scheduler = TurnScheduler()
+		for obj in self:
+			self.tiles.setdefault((obj.x, obj.y), []).append(obj)
+			if obj.ai:
+				self.scheduler.add(obj)
+		if grid is not None:
+			#the blocking objects, counted in one go
+			grid.clear_blockers()
+			blocking = numpy.array([(obj.x, obj.y) for obj in self if obj.blocks], dtype=int).reshape(-1, 2)
+			numpy.add.at(grid.blockers, (blocking[:, 0], blocking[:, 1]), 1)
+			grid.occupied |= grid.blockers > 0
+		
+	def _index(self, obj, front=False):
+		bucket = self.tiles.setdefault((obj.x, obj.y), [])
+		if front:
+			bucket.insert(0, obj)
+		else:
+			bucket.append(obj)
+		if obj.blocks and self.grid is not None:
+			self.grid.add_blocker(obj.x, obj.y)
+		
+	def append(self, obj):
+		list.append(self, obj)
+		self._index(obj)
+		if obj.ai:
+			self.scheduler.add(obj)
+		
+	def insert(self, index, obj):
+		list.insert(self, index, obj)
+		self._index(obj, front=(index == 0))
+		if obj.ai:
+			self.scheduler.add(obj)
+			
+	def extend(self, objects):
+		for obj in objects:
+			self.append(obj)
+			
+	def index(self, obj):
+		#like list.index(), by identity: comparing old-style instances is slow
+		for (i, other) in enumerate(self):
+			if other is obj:
+				return i
+		raise ValueError('object not in the list')
+			
+	def remove(self, obj):
+		list.remove(self, obj)
+		self._unindex(obj)
+		self.scheduler.remove(obj)
+		
+	def _unindex(self, obj):
+		bucket = self.tiles[(obj.x, obj.y)]
+		bucket.remove(obj)
+		if not bucket:
+			del self.tiles[(obj.x, obj.y)]
+		if obj.blocks and self.grid is not None:
+			self.grid.remove_blocker(obj.x, obj.y)
+		
+	def _contains(self, obj):
+		return obj in self.tiles.get((obj.x, obj.y), ())
+		
+	def move(self, obj, x, y):
+		#put the object on (x, y); objects that aren't on the level (e.g. carried items) just get the new coordinates
+		if self._contains(obj):
+			self._unindex(obj)
+			(obj.x, obj.y) = (x, y)
+			self._index(obj)
+		else:
+			(obj.x, obj.y) = (x, y)
+			
+	def set_blocks(self, obj, blocks):
+		#change whether the object blocks its tile
+		if self._contains(obj):
+			self._unindex(obj)
+			obj.blocks = blocks
+			self._index(obj)
+		else:
+			obj.blocks = blocks
+			
+	def send_to_back(self, obj):
+		#drawn first on the level and on its tile (its turns don't change)
+		list.remove(self, obj)
+		self._unindex(obj)
+		list.insert(self, 0, obj)
+		self._index(obj, front=True)
+		
+	def at(self, x, y):
+		#the objects on a tile, in drawing order
+		return tuple(self.tiles.get((x, y), ()))
+		
+	def blocker_at(self, x, y):
+		#the object blocking a tile, if any
+		for obj in self.tiles.get((x, y), ()):
+			if obj.blocks:
+				return obj
+		return None
 		
-		if x is not None and libtcod.map_is_in_fov(fov_map, self.x, self.y): #map[self.x][self.y].explored:
-			libtcod.console_put_char(con, x, y, '.', color_dark_ground)
-		elif x is not None:
-			libtcod.console_put_char_ex(con, x, y, '.',libtcod.black, libtcod.black)
 			
+class AliasTable:
+	#picks keys at random by their chances in constant time (Vose's alias method). the keys keep the order
+	#they're given in, ones without a chance are left out. all integers, so the draws are exact
+	def __init__(self, chances):
+		self.keys = [key for (key, chance) in chances if chance > 0]
+		weights = [chance for (key, chance) in chances if chance > 0]
+		n = len(self.keys)
+		self.total = sum(weights)
+		
+		#n columns of total chance each: a column holds share of its own key and the rest of its alias
+		scaled = [weight * n for weight in weights]
+		self.share = [self.total] * n
+		self.alias = list(range(n))
+		small = [i for i in range(n) if scaled[i] < self.total]
+		large = [i for i in range(n) if scaled[i] >= self.total]
+		while small and large:
+			(s, l) = (small.pop(), large.pop())
+			self.share[s] = scaled[s]
+			self.alias[s] = l
+			scaled[l] -= self.total - scaled[s]
+			if scaled[l] < self.total:
+				small.append(l)
+			else:
+				large.append(l)
+				
+	def sample(self, rng, count):
+		#count keys drawn with the generator rng
+		if not self.keys:
+			return []
+		choices = []
+		for i in range(count):
+			column = libtcod.random_get_int(rng, 0, len(self.keys) - 1)
+			if libtcod.random_get_int(rng, 0, self.total - 1) < self.share[column]:
+				choices.append(self.keys[column])
+			else:
+				choices.append(self.keys[self.alias[column]])
+		return choices
+		
+		
+class SpawnTables:
+	#how many monsters and items a room on a dungeon level may get, and what they are likely to be
+	def __init__(self, depth):
+		# ! # here be spawn rates # ! #
+		
+		#maximum number of monsters per room
+		self.max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]], depth)
+		
+		#chance of each monster
+		self.monsters = AliasTable([
+			('aardwurm', 80), # always show up, even if all other monsters have 0 chance
+			('caco', from_dungeon_level([[15, 3], [30, 5], [40, 10]], depth)),
+			('fiend', from_dungeon_level([[10, 2], [30, 5], [60, 7]], depth)),
+			('korky', from_dungeon_level([[1, 1], [5, 3], [20, 6]], depth))])
+			
+		#maximum number of items per room
+		self.max_items = from_dungeon_level([[1, 1], [2, 4]], depth)
+		
+		#chance of each item (by default they have chance 0 at level 1, which then goes up)
+		self.items = AliasTable([
+			('dig', from_dungeon_level([[5, 1]], depth)),
+			('lightning', from_dungeon_level([[25, 4]], depth)),
+			('fireball', from_dungeon_level([[25, 6]], depth)),
+			('confuse', from_dungeon_level([[10, 2]], depth)),
+			('heal', from_dungeon_level([[35, 1]], depth))])
+			
+			
+class Level:
+	#a dungeon level: its map, its objects (the player is one of them only while it's the current level),
+	#the stairs, where the player starts, and the theme and look it is drawn with
+	def __init__(self, depth, seed, grid, objects=None):
+		self.depth = depth
+		self.seed = seed
+		self.rng = None #only while generating
+		self.map = grid
+		if objects is None:
+			objects = ObjectRegistry([], grid)
+		self.objects = objects
+		self.start = None
+		self.downstairs = None
+		self.upstairs = None
+		self.look = {}
+		self.regions = None #statistics of the floor regions, from connect_regions()
+		self.spawns = get_spawn_tables(depth)
+		
+		
+class LevelStore:
+	#the levels the player left, by depth. the capacity most recently stored stay in memory, older ones
+	#are written to a save file each in directory (and read back when asked for)
+	def __init__(self, directory=LEVEL_DIRECTORY, capacity=LEVELS_IN_MEMORY):
+		self.directory = directory
+		self.capacity = capacity
+		self.hot = collections.OrderedDict() #depth -> level, least recently stored first
+		self.unsaved = set() #hot levels that changed since they were last written
+		self.cold = set() #depths of levels only on disk
+		if os.path.isdir(directory):
+			for name in os.listdir(directory):
+				if name.startswith('level') and name.endswith('.sav'):
+					self.cold.add(int(name[len('level'):-len('.sav')]))
+					
+	def path(self, depth):
+		return os.path.join(self.directory, 'level%d.sav' % depth)
+		
+	def __contains__(self, depth):
+		return depth in self.hot or depth in self.cold
+		
+	def put(self, level):
+		self.hot.pop(level.depth, None)
+		self.hot[level.depth] = level
+		self.unsaved.add(level.depth)
+		while len(self.hot) > self.capacity:
+			(depth, old) = self.hot.popitem(last=False)
+			self.write(old)
+			
+	def get(self, depth):
+		#the level at depth, or None if it was never stored. it's no longer in the store afterwards
+		if depth in self.hot:
+			self.unsaved.discard(depth)
+			return self.hot.pop(depth)
+		if depth in self.cold:
+			save_writer.flush() #the file may still be waiting to be written
+			reader = SaveReader(self.path(depth))
+			try:
+				return decode_level(reader)
+			finally:
+				reader.close()
+		return None
+		
+	def write(self, level):
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		save_writer.submit(self.path(level.depth), self.write_file, snapshot_level(level, RecordCodec()))
+		self.cold.add(level.depth)
+		self.unsaved.discard(level.depth)
+		
+	def write_file(self, level):
+		#(on the save writer's thread; write_save() replaces the old file in one step)
+		write_save(self.path(level['info']['depth']), encode_level(level))
+		
+	def flush(self):
+		#write the levels changed since they were stored (they stay in memory too)
+		for depth in list(self.unsaved):
+			self.write(self.hot[depth])
+			
+	def clear(self):
+		#forget every level, the files too
+		save_writer.flush()
+		for depth in self.cold:
+			if os.path.exists(self.path(depth)):
+				os.remove(self.path(depth))
+		self.hot.clear()
+		self.unsaved.clear()
+		self.cold.clear()
+		
+		
+class SaveError(Exception):
+	pass
+	
+	
+class SaveReader:
+	#a save file opened for reading. only the header and the table of contents are read (and checked)
+	#up front, every section is read, checked and decompressed when asked for
+	HEADER = struct.Struct('<8sHHI') #magic, format version, number of sections, crc32 of the contents
+	ENTRY = struct.Struct('<16sBIIII') #section name, compression, offset, stored size, size, crc32
+	MAGIC = b'PYRGSAVE'
+	COMPRESSIONS = {0: None, 1: 'zlib', 2: 'lzma'}
+	
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		(magic, version, count, crc) = self.HEADER.unpack(self.file.read(self.HEADER.size))
+		if magic != self.MAGIC:
+			raise SaveError('not a save file: ' + path)
+		if version != SAVE_FORMAT_VERSION:
+			raise SaveError('save format %d, this game reads %d' % (version, SAVE_FORMAT_VERSION))
+		contents = self.file.read(self.ENTRY.size * count)
+		if zlib.crc32(contents) & 0xffffffff != crc:
+			raise SaveError('damaged save file: ' + path)
+		self.sections = {}
+		for i in range(count):
+			entry = self.ENTRY.unpack_from(contents, i * self.ENTRY.size)
+			self.sections[entry[0].rstrip(b'\0').decode('ascii')] = entry[1:]
+			
+	def __contains__(self, name):
+		return name in self.sections
+		
+	def read(self, name):
+		(compression, offset, stored, size, crc) = self.sections[name]
+		self.file.seek(offset)
+		data = self.file.read(stored)
+		compression = self.COMPRESSIONS[compression]
+		if compression == 'zlib':
+			data = zlib.decompress(data)
+		elif compression == 'lzma':
+			if lzma is None:
+				raise SaveError('the save was compressed with lzma, which is missing here')
+			data = lzma.decompress(data)
+		if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+			raise SaveError('damaged section ' + name)
+		return data
+		
+	def read_json(self, name):
+		return json.loads(self.read(name).decode('utf-8'))
+		
+	def close(self):
+		self.file.close()
+		
+		
+class Blank:
+	#stands in for an instance of a class while it's being loaded, without running its __init__
+	pass
+	
+	
+class SaveWriter:
+	#writes save files in a background thread. a save is handed over as a snapshot of what to save and
+	#the function that writes it. only the latest save of a file matters, so a newer one replaces the
+	#one still waiting, and when limit files are waiting submit() waits for the writer. each file is
+	#written next to the old one, synced to disk and only then moved over it with replace_file()
+	def __init__(self, limit=SAVE_QUEUE_LIMIT):
+		self.limit = limit
+		self.pending = collections.OrderedDict() #path -> (write, snapshot), oldest first
+		self.busy = False
+		self.error = None #the exception of the last failed write, raised by flush()
+		self.condition = threading.Condition()
+		self.thread = None
+		self.closing = False
+		
+	def submit(self, path, write, snapshot):
+		with self.condition:
+			while path not in self.pending and len(self.pending) >= self.limit:
+				self.condition.wait()
+			self.pending[path] = (write, snapshot)
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run)
+				self.thread.daemon = True
+				self.thread.start()
+			self.condition.notify_all()
 			
+	def run(self):
+		while True:
+			with self.condition:
+				while not self.pending and not self.closing:
+					self.condition.wait()
+				if not self.pending:
+					return
+				(path, (write, snapshot)) = self.pending.popitem(last=False)
+				self.busy = True
+				self.condition.notify_all()
+			error = None
+			try:
+				write(snapshot)
+			except Exception as e:
+				error = e
+			with self.condition:
+				self.busy = False
+				if error is not None:
+					self.error = error
+				self.condition.notify_all()
+				
+	def flush(self):
+		#wait until every save handed over is on disk
+		with self.condition:
+			while self.pending or self.busy:
+				self.condition.wait()
+			(error, self.error) = (self.error, None)
+		if error is not None:
+			raise error
+			
+	def close(self):
+		#write what's waiting and stop the thread (the next submit() starts a new one)
+		with self.condition:
+			self.closing = True
+			self.condition.notify_all()
+		if self.thread is not None:
+			self.thread.join()
+		(self.thread, self.closing) = (None, False)
+		self.flush()
+			
+			
+class SaveJournal:
+	#writes the game to the save file, and between two full saves appends the changes since the last
+	#save to the journal: tiles explored or dug, entities spawned, changed (moved, hurt) and removed, the
+	#order of the entities, the inventory and the rest of the game if they changed. entities are known by
+	#uid, their place in the save file's objects or a new number for those spawned since, and matched from
+	#one save to the next by their serial. the save file names the generation of its journal, so a journal
+	#left over from an older save is never applied
+	HEADER = struct.Struct('<8sHI') #magic, format version, generation
+	ENTRY = struct.Struct('<IIB') #size, crc32, whether it's compressed
+	MAGIC = b'PYRGJRNL'
+	
+	def __init__(self, path=SAVE_FILE, journal_path=SAVE_JOURNAL, limit=JOURNAL_LIMIT):
+		self.path = path
+		self.journal_path = journal_path
+		self.limit = limit
+		self.reset()
+		
+	def reset(self):
+		#the next save writes the save file anew. save_game() encodes the entities with codec, whose schemas
+		#go on growing from one save to the next (so the journal only adds the new ones)
+		self.depth = None
+		self.codec = RecordCodec()
+		
+	def write(self, snapshot):
+		#(on the save writer's thread) snapshot is what save_game() hands over
+		level = snapshot[0]
+		try:
+			if self.depth != level['info']['depth'] or self.size >= self.limit:
+				self.compact(*snapshot)
+			else:
+				self.append(*snapshot)
+		except:
+			self.depth = None
+			raise
+			
+	def compact(self, level, serials, inventory, game):
+		#write the whole game to the save file and start an empty journal
+		generation = struct.unpack('<I', os.urandom(4))[0]
+		sections = encode_level(level)
+		sections['inventory'] = encode_objects(inventory)
+		sections['game'] = json.dumps(game).encode('utf-8')
+		sections['journal'] = json.dumps({'generation': generation}).encode('utf-8')
+		write_save(self.path, sections)
+		with open(self.journal_path + '.tmp', 'wb') as file:
+			file.write(self.HEADER.pack(self.MAGIC, SAVE_FORMAT_VERSION, generation))
+			file.flush()
+			os.fsync(file.fileno())
+		replace_file(self.journal_path + '.tmp', self.journal_path)
+		
+		#what the next save is compared with
+		self.depth = level['info']['depth']
+		self.size = self.HEADER.size
+		self.schemas = len(level['schemas'])
+		self.order = list(range(len(serials)))
+		self.uids = dict(zip(serials, self.order))
+		self.records = dict(zip(self.order, level['records']))
+		self.next_uid = len(serials)
+		self.tiles = level['map'].tiles
+		self.inventory = inventory
+		self.game = game
+		
+	def append(self, level, serials, inventory, game):
+		#append an entry with the changes since the last save (if there are any)
+		entry = {}
+		(spawns, changes) = ([], [])
+		(uids, records) = ([], {})
+		for (serial, record) in zip(serials, level['records']):
+			uid = self.uids.get(serial)
+			if uid is None:
+				uid = self.next_uid
+				self.next_uid += 1
+				spawns.append([uid, record])
+			else:
+				old = self.records[uid]
+				if old['r'] != record['r']:
+					spawns.append([uid, record])
+				elif old['v'] != record['v']:
+					changes.append([uid, [[i, value] for (i, (was, value)) in enumerate(zip(old['v'], record['v']))
+						if was != value]])
+			uids.append(uid)
+			records[uid] = record
+		removed = [uid for uid in self.records if uid not in records]
+		if len(level['schemas']) > self.schemas:
+			entry['schemas'] = level['schemas'][self.schemas:]
+		if spawns:
+			entry['spawn'] = spawns
+		if changes:
+			entry['set'] = changes
+		if removed:
+			entry['remove'] = removed
+		if uids != self.order:
+			entry['order'] = uids
+			
+		changed = numpy.flatnonzero(self.tiles.reshape(-1) != level['map'].tiles.reshape(-1))
+		if len(changed):
+			tiles = level['map'].tiles.reshape(-1)[changed]
+			values = (tiles['blocked'].astype(int) | tiles['block_sight'].astype(int) << 1 |
+				tiles['explored'].astype(int) << 2 | tiles['kind'].astype(int) << 3)
+			entry['tiles'] = [changed.tolist(), values.tolist()]
+			
+		if inventory != self.inventory:
+			entry['inventory'] = inventory
+		if game != self.game:
+			entry['game'] = game
+			
+		if entry:
+			data = json.dumps(entry, separators=(',', ':')).encode('utf-8')
+			compressed = zlib.compress(data, 6)
+			if len(compressed) < len(data):
+				(data, flag) = (compressed, 1)
+			else:
+				flag = 0
+			with open(self.journal_path, 'ab') as file:
+				file.write(self.ENTRY.pack(len(data), zlib.crc32(data) & 0xffffffff, flag) + data)
+				file.flush()
+				os.fsync(file.fileno())
+			self.size += self.ENTRY.size + len(data)
+			
+		self.schemas = len(level['schemas'])
+		(self.order, self.records) = (uids, records)
+		self.uids = dict(zip(serials, uids))
+		(self.tiles, self.inventory, self.game) = (level['map'].tiles, inventory, game)
+		
+		
+class InputLog:
+	#records the input of a session to a file: the master seed, then every key press and mouse click the
+	#game read, in order, so replay() can play the session back. each event is written as it happens
+	HEADER = struct.Struct('<8sHI') #magic, format version, master seed
+	EVENT = struct.Struct('<BiBBhhhhB') #event, key code, character, key flags, mouse cell, mouse pixel, mouse flags
+	MAGIC = b'PYRGKEYS'
+	VERSION = 1
+	KEY_FLAGS = ('pressed', 'lalt', 'lctrl', 'ralt', 'rctrl', 'shift')
+	MOUSE_FLAGS = ('lbutton', 'rbutton', 'mbutton', 'lbutton_pressed', 'rbutton_pressed', 'mbutton_pressed',
+		'wheel_up', 'wheel_down')
+	
+	def __init__(self, path, seed):
+		self.file = open(path, 'wb')
+		self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, seed))
+		self.file.flush()
+		
+	def record(self, event, key, mouse):
+		#only what the game acts on: key presses and mouse clicks, not the mouse moving about
+		pressed = key is not None and key.vk != libtcod.KEY_NONE
+		clicked = mouse is not None and (mouse.lbutton_pressed or mouse.rbutton_pressed or mouse.mbutton_pressed)
+		if not (pressed or clicked):
+			return
+		(event, vk, c, key_flags) = (libtcod.EVENT_NONE, 0, 0, 0)
+		(cx, cy, x, y, mouse_flags) = (0, 0, 0, 0, 0)
+		if pressed:
+			(event, vk, c) = (libtcod.EVENT_KEY_PRESS, key.vk, key.c)
+			key_flags = sum(getattr(key, name) << i for (i, name) in enumerate(self.KEY_FLAGS))
+		if clicked:
+			event |= libtcod.EVENT_MOUSE_RELEASE
+			(cx, cy, x, y) = (mouse.cx, mouse.cy, mouse.x, mouse.y)
+			mouse_flags = sum(getattr(mouse, name) << i for (i, name) in enumerate(self.MOUSE_FLAGS))
+		self.file.write(self.EVENT.pack(event, vk, c, key_flags, cx, cy, x, y, mouse_flags))
+		self.file.flush()
+		
+	def close(self):
+		self.file.close()
+		
+		
+class RecordCodec:
+	#turns entities and their components into typed records, and back. a record is {'r': schema number,
+	#'v': [field values]} and the schemas ([class name, [field names]]) are listed once, next to the
+	#records. colors are {'c': [r, g, b]} and functions {'f': name}. the journal keeps records like this
+	#(json can store them), save files keep them packed (see pack)
+	
+	#attributes that are worked out again after loading, rather than saved
+	TRANSIENT = ('owner', 'equipped', 'bonuses', 'path_cache')
+	
+	#values stored as they are (PLAIN_TYPES to tell them by their type, which is quicker than isinstance)
+	PLAIN = (int, type(2 ** 64), float, str, type(u''), bool, type(None))
+	PLAIN_TYPES = frozenset(PLAIN)
+	
+	#json gives strings back as unicode on python 2, where the game (and libtcod) wants str
+	UNICODE = (type(u''),) if str is bytes else ()
+	
+	#the only classes and functions a save may name, so a save file can't make or call anything else
+	CLASSES = ('Object', 'Fighter', 'Item', 'Equipment', 'BasicMonster', 'IdlingMonster', 'ConfusedMonster')
+	FUNCTIONS = ('player_death', 'monster_death', 'monster_idle', 'cast_heal', 'cast_lightning', 'cast_fireball',
+		'cast_confuse', 'cast_dig')
+		
+	#a packed record is one struct of its layout (its schema and the type of each field): the number of the
+	#layout, then the fields. the struct format of each type: True/False, int, long, float, None, string,
+	#function, color (as 0xrrggbb), record and anything else. strings, function names and anything else (as
+	#json) are numbers into a table of strings. None takes no room, a record is a 0 byte and follows the
+	#one it's in
+	LAYOUT = struct.Struct('<H')
+	FORMATS = {'?': '?', 'i': 'i', 'q': 'q', 'd': 'd', 'n': '', 's': 'I', 'f': 'I', 'c': 'I', 'r': 'B', 'j': 'I'}
+	
+	#the type of a value by its class (dicts are records, colors or functions)
+	CODES = {bool: '?', int: 'i', type(2 ** 64): 'i', float: 'd', type(None): 'n', str: 's', type(u''): 's', dict: 'D'}
+	
+	def __init__(self, schemas=()):
+		self.schemas = []
+		self.classes = []
+		self.numbers = {} #(class name, fields) -> schema number
+		self.known = {} #(class, attribute names in the order of the instance's __dict__) -> (schema number, fields)
+		self.extend(schemas)
+		
+	def extend(self, schemas):
+		#add schemas after the ones known (e.g. those a journal entry adds)
+		for (name, fields) in schemas:
+			(name, fields) = (str(name), [str(field) for field in fields])
+			self.classes.append(self.resolve(name, self.CLASSES))
+			self.numbers[(name, tuple(fields))] = len(self.schemas)
+			self.schemas.append([name, fields])
+			
+	def resolve(self, name, names):
+		if name not in names:
+			raise SaveError('the save names %r, which is not a class or function of the game' % name)
+		return globals()[name]
+		
+	def encode(self, value):
+		#the common cases first: plain values, colors and instances of a schema met before
+		kind = type(value)
+		if kind in self.PLAIN_TYPES:
+			return value
+		if kind is libtcod.Color:
+			return {'c': [value.r, value.g, value.b]}
+		attributes = getattr(value, '__dict__', None)
+		known = attributes is not None and self.known.get((value.__class__, tuple(attributes)))
+		if known:
+			(number, fields) = known
+			plain = self.PLAIN_TYPES
+			values = [attributes[field] for field in fields]
+			return {'r': number, 'v': [item if type(item) in plain else self.encode(item) for item in values]}
+			
+		if isinstance(value, numpy.generic): #e.g. a coordinate taken from a numpy array
+			return value.item()
+		if isinstance(value, self.PLAIN):
+			return value
+		if isinstance(value, libtcod.Color):
+			return {'c': [value.r, value.g, value.b]}
+		if isinstance(value, (list, tuple)):
+			return [self.encode(item) for item in value]
+		if isinstance(value, dict):
+			return dict((key, self.encode(item)) for (key, item) in value.items())
+		if callable(value):
+			if value.__name__ not in self.FUNCTIONS:
+				raise TypeError('cannot save the function %s (see RecordCodec.FUNCTIONS)' % value.__name__)
+			return {'f': value.__name__}
+		if attributes is None:
+			raise TypeError('cannot save a value of type %s: %r' % (type(value).__name__, value))
+		self.known[(value.__class__, tuple(attributes))] = self.schema(value)
+		return self.encode(value)
+		
+	def schema(self, value):
+		#the schema number and fields of an instance, a new schema for the first one of its kind
+		fields = tuple(sorted(key for key in value.__dict__ if key not in self.TRANSIENT))
+		schema = (value.__class__.__name__, fields)
+		number = self.numbers.get(schema)
+		if number is None:
+			if schema[0] not in self.CLASSES:
+				raise TypeError('cannot save an instance of %s (see RecordCodec.CLASSES)' % schema[0])
+			number = self.numbers[schema] = len(self.schemas)
+			self.schemas.append([schema[0], list(fields)])
+			self.classes.append(value.__class__)
+		return (number, fields)
+		
+	def decode(self, value, owner=None):
+		#components get owner as theirs (an entity is the owner of the components in its record)
+		if isinstance(value, list):
+			return [self.decode(item, owner) for item in value]
+		if not isinstance(value, dict):
+			if isinstance(value, self.UNICODE):
+				return value.encode('utf-8')
+			return value
+		if 'c' in value:
+			return libtcod.Color(*value['c'])
+		if 'f' in value:
+			return self.resolve(value['f'], self.FUNCTIONS)
+		if 'r' in value:
+			instance = Blank()
+			instance.__class__ = self.classes[value['r']]
+			fields = self.schemas[value['r']][1]
+			inner = instance if owner is None else owner
+			nested = (list, dict) + self.UNICODE
+			instance.__dict__.update(zip(fields, [self.decode(item, inner) if isinstance(item, nested) else item
+				for item in value['v']]))
+			if owner is not None:
+				instance.owner = owner
+			if isinstance(instance, Fighter):
+				instance.reindex_equipment([])
+			return instance
+		return dict((self.decode(key), self.decode(item, owner)) for (key, item) in value.items())
+		
+	def pack(self, records):
+		#the records as bytes: the size of a json head with the schemas, the layouts and the strings, the head,
+		#then the packed records in order (each followed by the records in it)
+		(layouts, strings, chunks) = ({}, {}, [])
+		for record in records:
+			self.pack_record(record, layouts, strings, chunks)
+		head = {'schemas': self.schemas, 'count': len(records),
+			'layouts': [list(key) for (key, layout) in sorted(layouts.items(), key=lambda item: item[1][0])],
+			'strings': [text for (text, number) in sorted(strings.items(), key=lambda item: item[1])]}
+		head = json.dumps(head, separators=(',', ':')).encode('utf-8')
+		return struct.pack('<I', len(head)) + head + b''.join(chunks)
+		
+	def pack_record(self, record, layouts, strings, chunks):
+		(codes, values, nested) = ([], [], [])
+		for value in record['v']:
+			code = self.CODES.get(value.__class__, 'j') #lists (encode() leaves no other types)
+			if code == 'i' and not -2 ** 31 <= value < 2 ** 31:
+				code = 'q' if -2 ** 63 <= value < 2 ** 63 else 'j'
+			elif code == 'n':
+				codes.append(code)
+				continue
+			elif code == 'D':
+				if 'r' in value:
+					nested.append(value)
+					(code, value) = ('r', 0)
+				elif 'c' in value:
+					(r, g, b) = value['c']
+					(code, value) = ('c', r << 16 | g << 8 | b)
+				elif 'f' in value:
+					(code, value) = ('f', value['f'])
+				else:
+					code = 'j'
+			if code in ('s', 'f', 'j'):
+				text = json.dumps(value) if code == 'j' else value
+				value = strings.get(text)
+				if value is None:
+					value = strings[text] = len(strings)
+			codes.append(code)
+			values.append(value)
+		key = (record['r'], ''.join(codes))
+		layout = layouts.get(key)
+		if layout is None:
+			layout = layouts[key] = (len(layouts), struct.Struct('<H' + ''.join(self.FORMATS[code] for code in codes)))
+		chunks.append(layout[1].pack(layout[0], *values))
+		for inner in nested:
+			self.pack_record(inner, layouts, strings, chunks)
+			
+	def unpack(self, data):
+		#the entities of records packed by pack(), and the schema number of each. their schemas are added to
+		#the codec, which must be a new one
+		(size,) = struct.unpack_from('<I', data)
+		head = json.loads(data[4:4 + size].decode('utf-8'))
+		self.extend(head['schemas'])
+		strings = head['strings']
+		if self.UNICODE:
+			strings = [text.encode('utf-8') for text in strings]
+			
+		#the layouts: the struct, the fields in it, those that aren't stored as they are (all but numbers and
+		#True/False) and those that are None
+		layouts = []
+		for (schema, codes) in head['layouts']:
+			layout = struct.Struct('<H' + ''.join(self.FORMATS[code] for code in codes))
+			fields = list(zip(self.schemas[schema][1], codes))
+			stored = [(field, code) for (field, code) in fields if code != 'n']
+			special = [(i, str(code)) for (i, (field, code)) in enumerate(stored, 1) if code not in '?iqd']
+			nones = dict((field, None) for (field, code) in fields if code == 'n')
+			layouts.append((schema, layout, special, [field for (field, code) in stored], nones))
+			
+		(entities, numbers) = ([], [])
+		offset = 4 + size
+		for i in range(head['count']):
+			numbers.append(layouts[self.LAYOUT.unpack_from(data, offset)[0]][0])
+			(entity, offset) = self.unpack_record(data, offset, layouts, strings)
+			entities.append(entity)
+		return (entities, numbers)
+		
+	def unpack_record(self, data, offset, layouts, strings, owner=None):
+		#the instance packed at offset and the offset after it (and the records in it)
+		(schema, layout, special, fields, nones) = layouts[self.LAYOUT.unpack_from(data, offset)[0]]
+		values = list(layout.unpack_from(data, offset))
+		offset += layout.size
+		instance = Blank()
+		instance.__class__ = self.classes[schema]
+		inner = instance if owner is None else owner
+		for (i, code) in special:
+			if code == 's':
+				values[i] = strings[values[i]]
+			elif code == 'r':
+				(values[i], offset) = self.unpack_record(data, offset, layouts, strings, inner)
+			elif code == 'c':
+				rgb = values[i]
+				values[i] = libtcod.Color(rgb >> 16, rgb >> 8 & 0xff, rgb & 0xff)
+			elif code == 'f':
+				values[i] = self.resolve(strings[values[i]], self.FUNCTIONS)
+			else:
+				values[i] = self.decode(json.loads(strings[values[i]]), inner)
+		instance.__dict__.update(zip(fields, values[1:]))
+		instance.__dict__.update(nones)
+		if owner is not None:
+			instance.owner = owner
+		if instance.__class__ is Fighter:
+			instance.reindex_equipment([])
+		return (instance, offset)
+		
+		
 class Item:
 	#an item that can be picked up and used
 	def __init__(self, use_function=None):
@@ -256,10 +1344,10 @@ class Item:
 			self.owner.equipment.dequip()
 		
 		#add to the map and remove from the players inventory, also place it at players coords
-		objects.append(self.owner)
-		inventory.remove(self.owner)
 		self.owner.x = player.x
 		self.owner.y = player.y
+		objects.append(self.owner)
+		inventory.remove(self.owner)
 		message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 		
 class Equipment:
@@ -288,17 +1376,20 @@ class Equipment:
 	
 		#equip object and show a message about it
 		self.is_equipped = True
+		player.fighter.wear(self)
 		message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_blue)
 		
 	def dequip(self):
 		#dequip + message
 		if not self.is_equipped: return
 		self.is_equipped = False
+		player.fighter.take_off(self)
 		message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_red)
 	
 		
 class Fighter:
 	#combat-related properties and methods (monster, player, npc)
+	
 	def __init__(self, hp, defense, power, xp, death_function=None, idle_function=None):
 		self.hp = hp
 		self.base_max_hp = hp
@@ -306,23 +1397,48 @@ class Fighter:
 		self.base_defense = defense
 		self.xp = xp
 		
+		#equipment worn, by slot
+		self.equipped = {}
+		#summed (power, defense, max_hp) bonuses of the equipment worn, None when it must be summed again
+		self.bonuses = (0, 0, 0)
+		
 		self.death_function = death_function
 		self.idle_function = idle_function
 	
 	@property
-	def power(self): #return actual power, by summing up bonuses from all equipped items
-		bonus = sum(equipment.power_bonus for equipment in get_all_equipped(self.owner))
-		return self.base_power + bonus
+	def power(self): #return actual power, base plus the bonuses from all equipped items
+		return self.base_power + self.get_bonuses()[0]
 	
 	@property
 	def defense(self):
-		bonus = sum(equipment.defense_bonus for equipment in get_all_equipped(self.owner))
-		return self.base_defense + bonus
+		return self.base_defense + self.get_bonuses()[1]
 		
 	@property
 	def max_hp(self):
-		bonus = sum(equipment.max_hp_bonus for equipment in get_all_equipped(self.owner))
-		return self.base_max_hp + bonus
+		return self.base_max_hp + self.get_bonuses()[2]
+		
+	def get_bonuses(self):
+		if self.bonuses is None:
+			worn = self.equipped.values()
+			self.bonuses = (sum(equipment.power_bonus for equipment in worn),
+				sum(equipment.defense_bonus for equipment in worn),
+				sum(equipment.max_hp_bonus for equipment in worn))
+		return self.bonuses
+		
+	def wear(self, equipment):
+		self.equipped[equipment.slot] = equipment
+		self.bonuses = None
+		
+	def take_off(self, equipment):
+		if self.equipped.get(equipment.slot) is equipment:
+			del self.equipped[equipment.slot]
+		self.bonuses = None
+		
+	def reindex_equipment(self, items):
+		#rebuild the worn equipment from the equipped items carried (saves from before the index lack it)
+		self.equipped = dict((item.equipment.slot, item.equipment) for item in items
+			if item.equipment and item.equipment.is_equipped)
+		self.bonuses = None
 
 		
 	def idle(self, turns):
@@ -374,24 +1490,111 @@ class Fighter:
 			monster.ai = ConfusedMonster(old_ai, CONFUSE_NUM_TURNS)
 			monster.ai.owner = monster #tell new component who owns it			
 	
+class PathCache:
+	#a monster's path to a target, kept from turn to turn so it costs a step per turn instead of a search.
+	#it is planned again only when the map changed, the target moved PATH_REPLAN_DISTANCE away from the end
+	#of the path, or the monster got off it or found it blocked
+	path = None
+	target = None
+	grid = None
+	version = None
+	
+	def plan(self, monster, x, y, avoid=None):
+		#find a path from the monster to (x, y), around the tile avoid if given
+		if self.path is not None:
+			libtcod.path_delete(self.path)
+		self.path = libtcod.path_new_using_function(map.width, map.height, self.cost)
+		(self.target, self.grid, self.version) = ((x, y), map, map.version)
+		(self.blocked, self.avoid) = (map.blocked.tolist(), avoid)
+		found = libtcod.path_compute(self.path, monster.x, monster.y, x, y)
+		return found and not libtcod.path_is_empty(self.path)
+		
+	def cost(self, x1, y1, x2, y2, userdata):
+		#the cost of a step between two tiles for the path search: 0 (no way) if either is a wall or the
+		#tile to go around, or if it's a diagonal past a wall corner (Object.move goes up or down first,
+		#which would take the monster only half of it)
+		if self.blocked[x1][y1] or self.blocked[x2][y2] or self.avoid in ((x1, y1), (x2, y2)):
+			return 0.0
+		if self.blocked[x1][y2] or self.blocked[x2][y1]:
+			return 0.0
+		return 1.0
+		
+	def blocked_step(self, monster, x, y):
+		#True if something stands on (x, y), or on the tile straight up or down on a diagonal step there
+		return is_blocked(x, y) or is_blocked(monster.x, y)
+		
+	def free(self):
+		#let go of the native path (the monster died, or its level was left)
+		if self.path is not None:
+			libtcod.path_delete(self.path)
+			self.path = None
+			
+	def step(self, monster, x, y):
+		#move the monster one step along its path to (x, y); False if there's no way to go
+		if (self.path is None or self.grid is not map or self.version != map.version or
+			libtcod.path_is_empty(self.path) or
+			libtcod.path_get_origin(self.path) != (monster.x, monster.y) or
+			max(abs(x - self.target[0]), abs(y - self.target[1])) > PATH_REPLAN_DISTANCE):
+			if not self.plan(monster, x, y):
+				return False
+				
+		(nx, ny) = libtcod.path_get(self.path, 0)
+		if self.blocked_step(monster, nx, ny):
+			#someone is in the way, go around them
+			if not self.plan(monster, x, y, avoid=(nx, ny)):
+				return False
+			(nx, ny) = libtcod.path_get(self.path, 0)
+			if self.blocked_step(monster, nx, ny):
+				return False
+				
+		libtcod.path_walk(self.path, False)
+		monster.move(nx - monster.x, ny - monster.y)
+		return True
+		
 class BasicMonster:
 	#AI for a basic monster
+	path_cache = None
+	
 	def take_turn(self):
 		#basic monster takes turn. if you can see it, it can see you
 		monster = self.owner
 		#if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
 		
+		distance = monster.distance_to(player)
+		
 		#close enough to attack (if player is alive)
-		if monster.distance_to(player) == 1 and player.fighter.hp > 0:
+		if distance == 1 and player.fighter.hp > 0:
 			monster.fighter.attack(player)	
 
 		#if player is not within this range, the monster will randomly wander around
-		elif monster.distance_to(player) >= 7:
-			monster.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+		elif distance >= CHASE_RADIUS:
+			monster.move(libtcod.random_get_int(combat_rng, -1, 1), libtcod.random_get_int(combat_rng, -1, 1))
 			
-		#move towards player if far away
-		elif monster.distance_to(player) <= 7 and monster.distance_to(player) >= 2:
-			monster.move_towards(player.x, player.y)
+		#move towards player if far away: one step down the distance field all chasing monsters share
+		#(or along a path of its own when the way round is too long for the field)
+		else:
+			field = get_chase_field()
+			if field.at(monster.x, monster.y) == field.UNREACHABLE:
+				if self.path_cache is None:
+					self.path_cache = PathCache()
+				if not self.path_cache.step(monster, player.x, player.y):
+					monster.move_towards(player.x, player.y)
+			else:
+				step = field.downhill(monster.x, monster.y)
+				if step is not None:
+					monster.move(*step)
+					
+	def catch_up(self, turns):
+		#the monster was asleep far from the player for a number of turns, in which it would have wandered
+		#about. instead walk it up to about as far as a random walk that long gets, in one direction
+		monster = self.owner
+		dx = libtcod.random_get_int(combat_rng, -1, 1)
+		dy = libtcod.random_get_int(combat_rng, -1, 1)
+		for i in range(min(int(math.sqrt(turns)), CATCH_UP_STEPS)):
+			(x, y) = (monster.x, monster.y)
+			monster.move(dx, dy)
+			if (x, y) == (monster.x, monster.y):
+				break
 														
 class IdlingMonster:
 	#AI for monsters that should do nothing in particular for a number of turns
@@ -410,6 +1613,9 @@ class IdlingMonster:
 			self.owner.ai = self.old_ai
 			message('The ' + self.owner.name + ' stops waiting and looks at you menacingly!', libtcod.white)
 			
+	def catch_up(self, turns):
+		self.num_turns = max(self.num_turns - turns, 0)
+			
 class ConfusedMonster:
 	#AI used for a confused monster
 	def __init__(self, old_ai=None, num_turns=CONFUSE_NUM_TURNS):
@@ -418,11 +1624,11 @@ class ConfusedMonster:
 			
 	def take_turn(self):
 		monster = self.owner
-		if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+		if in_fov(monster.x, monster.y):
 			
 			if self.num_turns > 0: #still confused...
 				#move in a random direction and decrease number of turns confused
-				self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+				self.owner.move(libtcod.random_get_int(combat_rng, -1, 1), libtcod.random_get_int(combat_rng, -1, 1))
 				
 				if self.owner.name == 'fiend':
 					self.num_turns += 1
@@ -437,62 +1643,45 @@ class ConfusedMonster:
 ###############		
 # END CLASSES #
 ###############		
+
+#the game's save writer. whatever is still waiting gets written before the program exits
+save_writer = SaveWriter()
+atexit.register(save_writer.close)
+
+#a level still being pregenerated is waited for before the program exits too (registered after the save
+#writer, so it runs before it)
+atexit.register(lambda: drop_pregenerated_level())
+
+#and how it saves the game
+save_journal = SaveJournal()
 		
 def get_equipped_in_slot(slot):
-	for obj in inventory:
-		if obj.equipment and obj.equipment.slot == slot and obj.equipment.is_equipped:
-			return obj.equipment
-	return None
+	return player.fighter.equipped.get(slot)
 		
 def get_all_equipped(obj): #returns a list of equipped items
 	if obj == player:
-		equipped_list = []
-		for item in inventory:
-			if item.equipment and item.equipment.is_equipped:
-				equipped_list.append(item.equipment)
-		return equipped_list
+		return list(player.fighter.equipped.values())
 	else:
 		return [] #other objects have no equipment
 		
+def get_chase_field():
+	#the distance field towards the player, worked out again only after the player moved or the map changed
+	global chase_field
+	if (chase_field is None or chase_field.grid is not map or chase_field.version != map.version or
+		(chase_field.x, chase_field.y) != (player.x, player.y)):
+		chase_field = DistanceField(map, player.x, player.y, 2 * CHASE_RADIUS)
+	return chase_field
+	
 def is_blocked(x, y):
-	#first test the map tile
-	if map[x][y].blocked:
-		return True
-			
-	#now check for any blocking objects
-	for object in objects:
-		if object.blocks and object.x == x and object.y == y:
-			return True			
-	return False
-	
-def create_room(room):
-	global map
-	# go through the tiles in the rectangle and make them passable
-	for x in range(room.x1 + 1, room.x2):
-		for y in range(room.y1 + 1, room.y2):
-			map[x][y].blocked = False
-			map[x][y].block_sight = False
-			
-def create_circular_room(room):
-	global map
-	#centre of circle
-	cx = (room.x1 + room.x2) / 2 
-	cy = (room.y1 + room.y2) / 2 
+	#the map's occupancy combines blocked tiles and blocking objects
+	return map.occupied[x, y]
 	
-	#radius of circle; makes it fit in the room
-	width = room.x2 - room.x1
-	height = room.y2 - room.y1
-	r = min(width, height) / 2
+def create_room(grid, room):
+	# make the tiles inside the rectangle passable
+	grid.set_tiles(room.x1 + 1, room.y1 + 1, room.x2, room.y2, False)
 	
-	#go through the tiles in the circle and make them passable
-	for x in range(room.x1, room.x2 +1):
-		for y in range(room.y1, room.y2 +1):
-			if math.sqrt((x - cx) ** 2 + (y - cy) ** 2) <= r:
-				map[x][y].blocked = False
-				map[x][y].block_sight = False 
-
-def create_solid(room):
-	global map
+def circle_mask(room):
+	#boolean mask over the room's tiles (borders included) that fall inside the circle fitting in it
 	#centre of circle
 	cx = (room.x1 + room.x2) / 2 
 	cy = (room.y1 + room.y2) / 2 
@@ -502,147 +1691,47 @@ def create_solid(room):
 	height = room.y2 - room.y1
 	r = min(width, height) / 2
 	
-	#go through the tiles in the solid and block them
-	for x in range(room.x1, room.x2 +1):
-		for y in range(room.y1, room.y2 +1):
-			if math.sqrt((x - cx) ** 2 + (y - cy) ** 2) <= r:
-				map[x][y].blocked = True
-				map[x][y].block_sight = True 				
+	xs = numpy.arange(room.x1, room.x2 + 1)[:, numpy.newaxis]
+	ys = numpy.arange(room.y1, room.y2 + 1)[numpy.newaxis, :]
+	return (xs - cx) ** 2 + (ys - cy) ** 2 <= r ** 2
+	
+def create_circular_room(grid, room):
+	#make the tiles in the circle passable
+	grid.set_tiles(room.x1, room.y1, room.x2 + 1, room.y2 + 1, False, mask=circle_mask(room))
+
+def create_solid(grid, room):
+	#block the tiles in the solid
+	grid.set_tiles(room.x1, room.y1, room.x2 + 1, room.y2 + 1, True, mask=circle_mask(room))
 			
-def create_h_tunnel(x1, x2, y):
-	global map
+def create_h_tunnel(grid, x1, x2, y):
 	#horizontal tunnel. min() and max() are used in case x1>x2
-	for x in range(min(x1, x2), max(x1, x2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False 
+	grid.set_tiles(min(x1, x2), y, max(x1, x2) + 1, y + 1, False)
 	
-def create_v_tunnel(y1, y2, x):
-	global map
+def create_v_tunnel(grid, y1, y2, x):
 	#vertical tunnel
-	for y in range(min(y1, y2), max(y1, y2) + 1):
-		map[x][y].blocked = False
-		map[x][y].block_sight = False
+	grid.set_tiles(x, min(y1, y2), x + 1, max(y1, y2) + 1, False)
 		
-def create_d_tunnel(x1, x2, y1, y2, x, y):
-	global map
+def create_d_tunnel(grid, x1, x2, y1, y2, x, y):
 	#diagonal tunnel
-	for x in range(min(x1, x2), max(x1, x2) + 1): 
-		for y in range(min(y1, y2), max(y1, y2) + 1):
-			map[x][y].blocked = False
-			map[x][y].block_sight = False
+	grid.set_tiles(min(x1, x2), min(y1, y2), max(x1, x2) + 1, max(y1, y2) + 1, False)
 
 		
-def make_map():
-	global map, objects, downstairs, upstairs, theme
-	
-	global color_dark_wall, color_light_wall
-	global color_dark_ground, color_light_ground
-	
-	global char_for_dark_walls, char_for_light_walls
-	global char_color_on_dark_walls, char_color_on_light_walls
-	
-	global character_dark_floorstyle
-	global character_light_floorstyle
-	
-
-	#MAP THEME PARAMETERS
-		
-	#themed maps are maps that should have only one type of room-shape(style)
-	themed_map = False
-	theme_tech = False
-	theme_cave = False
-	no_theme = False
-	theme = False
+def carve_random_rooms(level, style, themed_map):
+	#the classic generator: up to MAX_ROOMS rooms at random spots, each joined to the one before.
+	#fills the rooms, sets where the player starts and returns the spots for the down and up stairs
+	rng = level.rng
 	
-	#roll to see if the map should be themed or not
-	decide_themed = libtcod.random_get_int(0, 0, 10)
-	if decide_themed < 5:
-		themed_map == True	
-		#decide which
-		theme_number = libtcod.random_get_int(0, 0, 10)
-		if theme_number < 5:
-			theme = theme_tech
-		elif theme_number > 5:
-			theme = theme_cave		
-	else:
-		theme = no_theme
-		
-	##################################################################
-	if theme == theme_cave:
-		#colors for the floor, walls and the characters on those walls
-		#dark:
-		color_dark_wall = libtcod.black
-		color_dark_ground = libtcod.darkest_sepia	
-		char_color_on_dark_walls = libtcod.desaturated_orange
-		
-		#light:
-		color_light_wall = libtcod.black
-		color_light_ground = libtcod.desaturated_yellow	
-		char_color_on_light_walls = libtcod.purple
-		
-		#characters used to display walls
-		char_for_dark_walls = '4'
-		char_for_light_walls = '4'
-
-		#characters used to display floors
-		character_dark_floorstyle = ' '
-		character_light_floorstyle = '.'
-	##################################################################
-	elif theme == theme_tech:
-		
-		color_dark_wall = libtcod.black
-		color_dark_ground = libtcod.darkest_sepia
-		char_color_on_dark_walls = libtcod.desaturated_orange
-		
-		color_light_wall = libtcod.black 
-		color_light_ground = libtcod.grey 
-		char_color_on_light_walls = libtcod.white
-	
-		char_for_dark_walls = 'L'
-		char_for_light_walls = 'L'
-		
-		character_dark_floorstyle = ' '
-		character_light_floorstyle = '.'
-	##################################################################
-	else:
-		theme == no_theme	
-	
-		color_dark_wall = libtcod.black
-		color_dark_ground = libtcod.darkest_green
-		char_color_on_dark_walls = libtcod.dark_green
-		
-		color_light_wall = libtcod.black
-		color_light_ground = libtcod.lighter_green
-		char_color_on_light_walls = libtcod.desaturated_green
-		
-		char_for_dark_walls = 'X'
-		char_for_light_walls = 'X'
-		
-		character_light_floorstyle = ' '
-		character_dark_floorstyle = '_'
-		
-	#making sure the initial room has a style associated with it:
-	style = libtcod.random_get_int(0, 0, 1)
-	
-	#list of objects starting with the player
-	objects = [player]
-		
-	#fill map with "blocked" tiles
-	map = [[ Tile(True)
-		for y in range(MAP_HEIGHT) ]
-			for x in range(MAP_WIDTH) ]
-				
 	rooms = []
 	num_rooms = 0
 	
 	# GO!
 	for r in range(MAX_ROOMS):
 		#random width and height
-		w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-		h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+		h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
 		#random position without going out of boundaries of map
-		x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 2) #changed from 1 to see
-		y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 2) #if it helps with the edge of the map (seems like it does)
+		x = libtcod.random_get_int(rng, 0, level.map.width - w - 2) #changed from 1 to see
+		y = libtcod.random_get_int(rng, 0, level.map.height - h - 2) #if it helps with the edge of the map (seems like it does)
 			
 		#rect class comes in play here	
 		new_room = Rect(x, y, w, h)
@@ -665,33 +1754,33 @@ def make_map():
 			#no intersections, room is valid;	
 			#"paint" it to the map's tiles
 			if themed_map == False: #if map is not themed, decide the style for this particular room 
-				style == libtcod.random_get_int(0, 0, 2)
+				style == libtcod.random_get_int(rng, 0, 2)
 				
 			if style == 0:
 				#squares
-				create_room(new_room)
+				create_room(level.map, new_room)
 			elif style == 1:
 				#circles
-				create_circular_room(new_room)
+				create_circular_room(level.map, new_room)
 			elif style == 2:
 				#solids
-				create_solid(new_room)
+				create_solid(level.map, new_room)
 			
 			if not solid:
 				#add contents to this room, such as monsters
-				place_objects(new_room)
+				place_objects(level, new_room)
 			
 			#center coords of new room, will be useful later
 			(new_x, new_y) = new_room.center()
 			
 			#optional bit of code to label rooms
 			room_no = Object(new_x, new_y, chr(65+num_rooms), 'Room Number', libtcod.white, blocks=False)
-			objects.insert(0, room_no) #draw early so monsters are drawn on top
+			level.objects.insert(0, room_no) #draw early so monsters are drawn on top
 					
 			if num_rooms == 0:
-				#first room, where player starts
-				player.x = new_x
-				player.y = new_y
+				#first room, where player starts (nothing else gets placed on that spot)
+				level.start = (new_x, new_y)
+				level.map.add_blocker(new_x, new_y)
 			elif not solid:
 				#all rooms after the first:
 				#connect it to the previous room with a tunnel
@@ -700,99 +1789,478 @@ def make_map():
 				(prev_x, prev_y) = rooms[num_rooms-1].center()
 				
 				#determine the direction of the tunnel
-				direction = libtcod.random_get_int(0, 0, 2)
+				direction = libtcod.random_get_int(rng, 0, 2)
 				if direction == 1:
 					#first move horizontally, then vertically
-					create_h_tunnel(prev_x, new_x, prev_y)
-					create_v_tunnel(prev_y, new_y, new_x)
+					create_h_tunnel(level.map, prev_x, new_x, prev_y)
+					create_v_tunnel(level.map, prev_y, new_y, new_x)
 				elif direction == 2:
 					#first move vertically, then horizontally
-					create_v_tunnel(prev_y, new_y, prev_x)
-					create_h_tunnel(prev_x, new_x, new_y)
+					create_v_tunnel(level.map, prev_y, new_y, prev_x)
+					create_h_tunnel(level.map, prev_x, new_x, new_y)
 				else:
 					#diagonally
-					create_d_tunnel(prev_x, new_x, prev_y, new_y, prev_x, prev_y)
+					create_d_tunnel(level.map, prev_x, new_x, prev_y, new_y, prev_x, prev_y)
 					
 					
 			#finally, append the new room to the list
 			rooms.append(new_room)
 			num_rooms += 1
-
-	#create stairs in the last room
-	downstairs = Object(new_x, new_y, '>', 'downstairs', libtcod.white, always_visible=True)
-	upstairs = Object(prev_x, prev_y, '<', 'upstairs', libtcod.white, always_visible=True)
-	objects.append(downstairs)
-	objects.append(upstairs)
-	#stairs.send_to_back() #draw below monsters
-
 	
-def random_choice_index(chances):
-	#choose one option from a list of chances, returning its index
-	#the dice will land on some number between 1 and the sum of the chances
-	dice = libtcod.random_get_int(0, 1, sum(chances))
+	return ((new_x, new_y), (prev_x, prev_y))
+	
+def label_regions(floor):
+	#number the (4-connected) regions of floor tiles 1, 2, ... and the rest 0. works on the vertical runs of
+	#floor in every column, joining each to the runs it touches in the column before with union-find,
+	#so it takes time linear in the size of the map. returns the labels and the number of regions
+	(w, h) = floor.shape
+	runs = []
+	parent = []
+	
+	def find(i):
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+		
+	padded = numpy.zeros(h + 2, dtype=numpy.int8)
+	before = []
+	for x in range(w):
+		padded[1:-1] = floor[x]
+		edges = numpy.flatnonzero(numpy.diff(padded)).tolist()
+		column = []
+		j = 0
+		for (y1, y2) in zip(edges[0::2], edges[1::2]):
+			i = len(runs)
+			runs.append((x, y1, y2))
+			parent.append(i)
+			column.append(i)
+			#the runs of the column before overlapping y1 <= y < y2 (both columns go down in order)
+			while j < len(before) and runs[before[j]][2] <= y1:
+				j += 1
+			k = j
+			while k < len(before) and runs[before[k]][1] < y2:
+				parent[find(before[k])] = find(i)
+				k += 1
+		before = column
+		
+	labels = numpy.zeros((w, h), dtype=numpy.int32)
+	numbers = {}
+	for (i, (x, y1, y2)) in enumerate(runs):
+		labels[x, y1:y2] = numbers.setdefault(find(i), len(numbers) + 1)
+	return (labels, len(numbers))
+	
+def connect_regions(grid, x, y):
+	#join every floor region to the one (x, y) is in, greedily near regions first: a 0-1 breadth-first
+	#search grows out from the joined tiles (crossing floor costs nothing and goes to the front of the
+	#queue, a wall costs one and goes to the back), and the first region it reaches gets a tunnel along
+	#the way it was reached. the region and its tunnel are joined tiles from then on (distance 0, put at
+	#the front), so the search goes on from them too. tiles queued before a join are still taken first,
+	#so a later region isn't always the nearest one nor its tunnel the shortest, and the total dug isn't
+	#the fewest possible. all the tunnels are dug at the end in one go. returns region statistics
+	(labels, count) = label_regions(~grid.blocked)
+	sizes = numpy.bincount(labels.ravel(), minlength=count + 1)[1:]
+	stats = {'regions': count, 'sizes': sorted(sizes.tolist(), reverse=True), 'dug': 0}
+	if count <= 1:
+		return stats
+		
+	#tiles as flat indices i = x * h + y, with the tiles of each region listed together
+	(w, h) = (grid.width, grid.height)
+	region = labels.ravel().tolist()
+	order = numpy.argsort(labels.ravel(), kind='mergesort').tolist()
+	ends = numpy.cumsum(numpy.bincount(labels.ravel(), minlength=count + 1)).tolist()
+	
+	home = region[x * h + y]
+	joined = [False] * (count + 1)
+	joined[home] = True
+	dist = [w * h] * (w * h)
+	came = [-1] * (w * h)
+	queue = collections.deque()
+	for i in order[ends[home - 1]:ends[home]]:
+		dist[i] = 0
+		queue.append((0, i))
+	dug = []
+	
+	while queue:
+		(d, i) = queue.popleft()
+		if d > dist[i]:
+			continue #it got closer since
+		r = region[i]
+		if r and not joined[r]:
+			#a new region: mark the walls on the way back to the joined ones, then grow from all of it
+			j = came[i]
+			while not region[j]:
+				dug.append(j)
+				region[j] = home
+				dist[j] = 0
+				queue.appendleft((0, j))
+				j = came[j]
+			joined[r] = True
+			for k in order[ends[r - 1]:ends[r]]:
+				dist[k] = 0
+				queue.appendleft((0, k))
+			continue
+			
+		(tx, ty) = (i // h, i % h)
+		for (n, inside) in ((i - 1, ty > 0), (i + 1, ty < h - 1), (i - h, tx > 0), (i + h, tx < w - 1)):
+			if not inside:
+				continue
+			if region[n]:
+				if d < dist[n]:
+					dist[n] = d
+					came[n] = i
+					queue.appendleft((d, n))
+			elif d + 1 < dist[n] and 0 < n // h < w - 1 and 0 < n % h < h - 1:
+				#walls on the map's border stay
+				dist[n] = d + 1
+				came[n] = i
+				queue.append((d + 1, n))
+				
+	#dig all the tunnels
+	if dug:
+		mask = numpy.zeros((w, h), dtype=bool)
+		mask.flat[dug] = True
+		grid.set_tiles(0, 0, w, h, False, mask=mask)
+	stats['dug'] = len(dug)
+	return stats
+	
+def smooth_cave(wall, passes):
+	#cellular automaton over the whole grid at once: a tile becomes wall when at least 5 of the 9 tiles
+	#in its 3x3 block are, counted by adding up the 9 shifted copies of the (padded) grid
+	(w, h) = wall.shape
+	for i in range(passes):
+		padded = numpy.ones((w + 2, h + 2), dtype=numpy.uint8)
+		padded[1:-1, 1:-1] = wall
+		count = numpy.zeros((w, h), dtype=numpy.uint8)
+		for dx in range(3):
+			for dy in range(3):
+				count += padded[dx:dx + w, dy:dy + h]
+		wall = count >= 5
+		wall[0, :] = wall[-1, :] = True
+		wall[:, 0] = wall[:, -1] = True
+	return wall
+	
+def carve_cave(level):
+	#caves: random noise smoothed by a cellular automaton, written into the map in one go. only the cave
+	#reachable from the player's start is kept. fills every CAVE_ZONE square that has some floor,
+	#sets where the player starts and returns the spots for the down and up stairs (furthest and start)
+	rng = level.rng
+	(w, h) = (level.map.width, level.map.height)
+	noise = numpy.random.RandomState(libtcod.random_get_int(rng, 0, 0x7fffffff))
+	wall = smooth_cave(noise.rand(w, h) < CAVE_WALL_CHANCE, CAVE_PASSES)
+	level.map.set_tiles(0, 0, w, h, False, mask=~wall)
+	
+	#start somewhere in the biggest cave (the few tries nearly always find it) and fill in the rest
+	floor = numpy.argwhere(~wall)
+	best = None
+	for i in range(CAVE_START_TRIES):
+		(x, y) = floor[libtcod.random_get_int(rng, 0, len(floor) - 1)]
+		field = DistanceField(level.map, x, y, w * h)
+		reached = field.steps != field.UNREACHABLE
+		if best is None or reached.sum() > best[1].sum():
+			best = ((x, y), reached, field)
+	((x, y), reached, field) = best
+	level.map.set_tiles(0, 0, w, h, True, mask=~wall & ~reached)
+	level.start = (int(x), int(y))
+	level.map.add_blocker(x, y)
+	
+	for zx in range(0, w - 2, CAVE_ZONE):
+		for zy in range(0, h - 2, CAVE_ZONE):
+			zone = Rect(zx, zy, min(CAVE_ZONE, w - 1 - zx), min(CAVE_ZONE, h - 1 - zy))
+			if reached[zone.x1 + 1:zone.x2, zone.y1 + 1:zone.y2].any():
+				place_objects(level, zone)
+				
+	steps = numpy.where(reached, field.steps, 0)
+	(far_x, far_y) = numpy.unravel_index(steps.argmax(), steps.shape)
+	return ((int(far_x), int(far_y)), level.start)
+	
+def carve_bsp(level, style):
+	#binary space partition: split the map in two, and the halves again, down to leaves of at most
+	#BSP_LEAF_SIZE, put a room in every leaf and join the two halves of every split with a tunnel.
+	#fills the rooms, sets where the player starts and returns the spots for the down and up stairs
+	rng = level.rng
+	rooms = []
+	
+	def split(x, y, w, h):
+		#a leaf gets a room, anything bigger is cut across its longer side. rooms are made in
+		#tree order, so the last room of the first half and the first of the second are neighbours
+		horizontal = h > w
+		size = h if horizontal else w
+		if size <= BSP_LEAF_SIZE or size < 2 * BSP_MIN_SIZE:
+			rw = libtcod.random_get_int(rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, w - 1))
+			rh = libtcod.random_get_int(rng, ROOM_MIN_SIZE, min(ROOM_MAX_SIZE, h - 1))
+			rx = libtcod.random_get_int(rng, x, x + w - 1 - rw)
+			ry = libtcod.random_get_int(rng, y, y + h - 1 - rh)
+			rooms.append(Rect(rx, ry, rw, rh))
+			return
+			
+		cut = libtcod.random_get_int(rng, BSP_MIN_SIZE, size - BSP_MIN_SIZE)
+		if horizontal:
+			split(x, y, w, cut)
+			joint = len(rooms)
+			split(x, y + cut, w, h - cut)
+		else:
+			split(x, y, cut, h)
+			joint = len(rooms)
+			split(x + cut, y, w - cut, h)
+		
+		(prev_x, prev_y) = rooms[joint - 1].center()
+		(new_x, new_y) = rooms[joint].center()
+		if libtcod.random_get_int(rng, 0, 1):
+			create_h_tunnel(level.map, prev_x, new_x, prev_y)
+			create_v_tunnel(level.map, prev_y, new_y, new_x)
+		else:
+			create_v_tunnel(level.map, prev_y, new_y, prev_x)
+			create_h_tunnel(level.map, prev_x, new_x, new_y)
+			
+	#the leaves (with their rooms' walls) stay off the map's border
+	split(1, 1, level.map.width - 2, level.map.height - 2)
 	
-	#go through all chances, keeping the sum so far
-	running_sum = 0
-	choice = 0
-	for w in chances:
-		running_sum += w
+	for (num_rooms, room) in enumerate(rooms):
+		#rooms are painted over the tunnels, which end in their centres anyway
+		if style == 0:
+			create_room(level.map, room)
+		else:
+			create_circular_room(level.map, room)
+		place_objects(level, room)
+		
+		(new_x, new_y) = room.center()
+		room_no = Object(new_x, new_y, chr(65 + num_rooms % 58), 'Room Number', libtcod.white, blocks=False)
+		level.objects.insert(0, room_no) #draw early so monsters are drawn on top
+		
+		if num_rooms == 0:
+			#first room, where player starts (nothing else gets placed on that spot)
+			level.start = (new_x, new_y)
+			level.map.add_blocker(new_x, new_y)
+			
+	if len(rooms) == 1:
+		#a single leaf (a small map, or a big BSP_MIN_SIZE): both stairs go in the start room, off the start
+		room = rooms[0]
+		spots = [(x, y) for x in range(room.x1, room.x2 + 1) for y in range(room.y1, room.y2 + 1)
+			if not level.map.blocked[x, y] and (x, y) != level.start]
+		return (spots[-1], spots[0])
+	return (rooms[-1].center(), rooms[-2].center())
+	
+def generate_level(depth, seed, generator=None, width=MAP_WIDTH, height=MAP_HEIGHT):
+	#generate dungeon level depth from its seed. none of the game's globals are touched (so this can
+	#run in a worker thread) and the same seed always makes the same level
+	level = Level(depth, seed, TileGrid(width, height)) #starts all "blocked" tiles
+	level.rng = rng = libtcod.random_new_from_seed(seed)
+	look = level.look
+	
+	#MAP THEME PARAMETERS
+		
+	#themed maps are maps that should have only one type of room-shape(style)
+	themed_map = False
+	theme_tech = 'tech'
+	theme_cave = 'cave'
+	no_theme = None
+	theme = no_theme
+	
+	#roll to see if the map should be themed or not
+	decide_themed = libtcod.random_get_int(rng, 0, 10)
+	if decide_themed < 5:
+		themed_map == True	
+		#decide which
+		theme_number = libtcod.random_get_int(rng, 0, 10)
+		if theme_number < 5:
+			theme = theme_tech
+		elif theme_number > 5:
+			theme = theme_cave		
+	else:
+		theme = no_theme
+	look['theme'] = theme
+		
+	##################################################################
+	if theme == theme_cave:
+		#colors for the floor, walls and the characters on those walls
+		#dark:
+		look['color_dark_wall'] = libtcod.black
+		look['color_dark_ground'] = libtcod.darkest_sepia	
+		look['char_color_on_dark_walls'] = libtcod.desaturated_orange
+		
+		#light:
+		look['color_light_wall'] = libtcod.black
+		look['color_light_ground'] = libtcod.desaturated_yellow	
+		look['char_color_on_light_walls'] = libtcod.purple
 		
-		#check if the dice landed in the part that corresponds with this choice
-		if dice <= running_sum:
-			return choice
-		choice += 1
+		#characters used to display walls
+		look['char_for_dark_walls'] = '4'
+		look['char_for_light_walls'] = '4'
 
-def random_choice(chances_dict):
-	#choose one option from dictionary of chances, returning its key
-	chances = chances_dict.values()
-	strings = chances_dict.keys()
+		#characters used to display floors
+		look['character_dark_floorstyle'] = ' '
+		look['character_light_floorstyle'] = '.'
+	##################################################################
+	elif theme == theme_tech:
+		
+		look['color_dark_wall'] = libtcod.black
+		look['color_dark_ground'] = libtcod.darkest_sepia
+		look['char_color_on_dark_walls'] = libtcod.desaturated_orange
+		
+		look['color_light_wall'] = libtcod.black 
+		look['color_light_ground'] = libtcod.grey 
+		look['char_color_on_light_walls'] = libtcod.white
+	
+		look['char_for_dark_walls'] = 'L'
+		look['char_for_light_walls'] = 'L'
+		
+		look['character_dark_floorstyle'] = ' '
+		look['character_light_floorstyle'] = '.'
+	##################################################################
+	else:
+		theme == no_theme	
+	
+		look['color_dark_wall'] = libtcod.black
+		look['color_dark_ground'] = libtcod.darkest_green
+		look['char_color_on_dark_walls'] = libtcod.dark_green
+		
+		look['color_light_wall'] = libtcod.black
+		look['color_light_ground'] = libtcod.lighter_green
+		look['char_color_on_light_walls'] = libtcod.desaturated_green
+		
+		look['char_for_dark_walls'] = 'X'
+		look['char_for_light_walls'] = 'X'
+		
+		look['character_light_floorstyle'] = ' '
+		look['character_dark_floorstyle'] = '_'
+		
+	#making sure the initial room has a style associated with it:
+	style = libtcod.random_get_int(rng, 0, 1)
+	
+	#carve out the rooms and tunnels and fill the rooms, with the chosen generator (cave levels are caves)
+	if generator is None:
+		generator = 'cave' if theme == theme_cave else MAP_GENERATOR
+	if generator == 'cave':
+		((new_x, new_y), (prev_x, prev_y)) = carve_cave(level)
+	elif generator == 'bsp':
+		((new_x, new_y), (prev_x, prev_y)) = carve_bsp(level, style)
+	else:
+		((new_x, new_y), (prev_x, prev_y)) = carve_random_rooms(level, style, themed_map)
+		
+	#make sure every bit of floor can be reached, the stairs included
+	level.regions = connect_regions(level.map, *level.start)
+	level.map.remove_blocker(*level.start)
 	
-	return strings[random_choice_index(chances)]
+	#create stairs in the last room
+	level.downstairs = Object(new_x, new_y, '>', 'downstairs', libtcod.white, always_visible=True)
+	level.upstairs = Object(prev_x, prev_y, '<', 'upstairs', libtcod.white, always_visible=True)
+	level.objects.append(level.downstairs)
+	level.objects.append(level.upstairs)
+	#stairs.send_to_back() #draw below monsters
 	
-def from_dungeon_level(table):
+	libtcod.random_delete(rng)
+	level.rng = None
+	return level
+	
+def enter_level(level, spot=None):
+	#make a level the current one, with the player at its start (or the given spot)
+	global current_level, map, objects, downstairs, upstairs
+	current_level = level
+	map = level.map
+	objects = level.objects
+	(player.x, player.y) = spot or level.start
+	objects.append(player)
+	downstairs = level.downstairs
+	upstairs = level.upstairs
+	use_look(level.look)
+	
+def use_look(look):
+	#the theme of the current level, and the colors and characters its map is drawn with
+	global theme, color_dark_wall, color_dark_ground, char_color_on_dark_walls, color_light_wall
+	global color_light_ground, char_color_on_light_walls, char_for_dark_walls, char_for_light_walls
+	global character_dark_floorstyle, character_light_floorstyle
+	theme = look['theme']
+	(color_dark_wall, color_dark_ground) = (look['color_dark_wall'], look['color_dark_ground'])
+	(color_light_wall, color_light_ground) = (look['color_light_wall'], look['color_light_ground'])
+	char_color_on_dark_walls = look['char_color_on_dark_walls']
+	char_color_on_light_walls = look['char_color_on_light_walls']
+	(char_for_dark_walls, char_for_light_walls) = (look['char_for_dark_walls'], look['char_for_light_walls'])
+	character_dark_floorstyle = look['character_dark_floorstyle']
+	character_light_floorstyle = look['character_light_floorstyle']
+	
+def make_map(seed=None):
+	#generate the current dungeon level, from its seed in this game unless another is given, and enter it
+	if seed is None:
+		seed = level_seed(game_seed, dungeon_level)
+	enter_level(generate_level(dungeon_level, seed))
+	
+def pregenerate_level(depth):
+	#start generating a level in a worker thread, while the current one is played
+	global next_level_worker
+	drop_pregenerated_level()
+	seed = level_seed(game_seed, depth)
+	result = []
+	worker = threading.Thread(target=lambda: result.append(generate_level(depth, seed)))
+	worker.daemon = True
+	worker.start()
+	next_level_worker = (depth, seed, worker, result)
+	
+def take_level(depth):
+	#the level pregenerated for depth (waiting for the worker if it isn't done yet), or else one generated now
+	seed = level_seed(game_seed, depth)
+	if next_level_worker is not None:
+		(pending_depth, pending_seed, worker, result) = next_level_worker
+		drop_pregenerated_level()
+		if (pending_depth, pending_seed) == (depth, seed) and result:
+			return result[0]
+	return generate_level(depth, seed)
+	
+def drop_pregenerated_level():
+	#forget the level being pregenerated, waiting for its worker so no thread is left running
+	global next_level_worker
+	if next_level_worker is not None:
+		next_level_worker[2].join()
+		next_level_worker = None
+		
+def level_seed(seed, level):
+	#the seed of a dungeon level: the (level + 1)th number drawn from the game's master seed
+	rng = libtcod.random_new_from_seed(seed)
+	for i in range(level + 1):
+		result = libtcod.random_get_int(rng, 0, 0x7fffffff)
+	libtcod.random_delete(rng)
+	return result
+	
+def start_random(seed):
+	#level generation and the combat and AI rolls draw from separate generators,
+	#so how a fight went doesn't change the levels that come after
+	global game_seed, combat_rng
+	game_seed = seed
+	drop_pregenerated_level()
+	if combat_rng is not None:
+		libtcod.random_delete(combat_rng) #the last game's
+	combat_rng = libtcod.random_new_from_seed(level_seed(seed, 0) ^ 0x5eed)
+	
+def from_dungeon_level(table, depth):
 	#returns a value that depends on dlevel.
 	#the table specifies what value occurs after each level, default=0
 	for (value, level) in reversed(table):
-		if dungeon_level >= level:
+		if depth >= level:
 			return value
 	return 0
 	
-def place_objects(room):
-	# ! # here be spawn rates # ! #
-	
-	#maximum number of monsters per room
-	max_monsters = from_dungeon_level([[2, 1], [3, 4], [5, 6]]) 
+def get_spawn_tables(depth):
+	#the spawn tables of a dungeon level, compiled the first time they're needed
+	tables = spawn_tables.get(depth)
+	if tables is None:
+		tables = spawn_tables.setdefault(depth, SpawnTables(depth))
+	return tables
 	
-	#chance of each monster
-	monster_chances = {} 
-	monster_chances['aardwurm'] = 80 # always show up, even if all other monsters have 0 chance
-	monster_chances['caco'] = from_dungeon_level([[15, 3], [30, 5], [40, 10]]) 
-	monster_chances['fiend'] = from_dungeon_level([[10, 2], [30, 5], [60, 7]])
-	monster_chances['korky'] = from_dungeon_level([[1, 1], [5, 3], [20, 6]])
+def place_objects(level, room):
+	#put monsters and items at random spots in the room, drawn from the level's spawn tables
+	spawns = level.spawns
+	rng = level.rng
 	
-	#maximum number of items per room
-	max_items = from_dungeon_level([[1, 1], [2, 4]])
+	#choose random number of MONSTERS, and what they are all at once
+	num_monsters = libtcod.random_get_int(rng, 0, spawns.max_monsters)
 	
-	#chance of each item (by default they have chance 0 at level 1, which then goes up)
-	item_chances = {}
-	#item_chances['heal'] = 35 #always potions, even if others are 0 chance
-	item_chances['dig'] = from_dungeon_level([[5, 1]])
-	item_chances['lightning'] = from_dungeon_level([[25, 4]])
-	item_chances['fireball'] = from_dungeon_level([[25, 6]])
-	item_chances['confuse'] = from_dungeon_level([[10, 2]])
-	item_chances['heal'] = from_dungeon_level([[35, 1]])
-
-	#choose random number of MONSTERS
-	num_monsters = libtcod.random_get_int(0, 0, max_monsters)
-	
-	for i in range(num_monsters):
+	for choice in spawns.monsters.sample(rng, num_monsters):
 		#choose random spot for this monster
-		x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+		x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+		y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
 			
 		#only place it if tile is not blocked
-		if not is_blocked(x, y):
-			choice = random_choice(monster_chances)
+		if not level.map.occupied[x, y]:
 			if choice == 'aardwurm':
 				#orc
 				fighter_component = Fighter(hp=20, defense=0, power=4, xp=100, death_function=monster_death, idle_function=monster_idle)
@@ -824,20 +2292,19 @@ def place_objects(room):
 				monster = Object(x, y, 'R', 'Korky', libtcod.light_sky, 
 					blocks=True, fighter=fighter_component, ai=ai_component)
 				
-			objects.append(monster)
+			level.objects.append(monster)
 
 
-	#choose random number of ITEMS
-	num_items = libtcod.random_get_int(0, 0, max_items)
+	#choose random number of ITEMS, and what they are all at once
+	num_items = libtcod.random_get_int(rng, 0, spawns.max_items)
 		
-	for i in range(num_items):
+	for choice in spawns.items.sample(rng, num_items):
 		#pick a spot for the item to spawn
-		x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-		y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+		x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+		y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
 			
 		#only place it if the tile is not blocked
-		if not is_blocked(x, y):
-			choice = random_choice(item_chances)
+		if not level.map.occupied[x, y]:
 			if choice == 'heal':
 				#create a healing potion 
 				item_component = Item(use_function=cast_heal)
@@ -860,26 +2327,46 @@ def place_objects(room):
 				item = Object(x, y, 'D', 'Digging Tool', libtcod.light_lime, item=item_component)
 			
 			
-			objects.append(item)
-			item.send_to_back() #items appear below other objects
+			level.objects.insert(0, item) #items appear below other objects
 			item.always_visible = False
 			
-def next_level():
+def change_level(depth):
+	#leave the current level for the one at depth, keeping the one left in the level store. a level
+	#visited before comes back from the store, with the player on the stairs they took, a new one is
+	#the level generated while the last one was played
 	global dungeon_level
+	level = levels.get(depth)
+	objects.remove(player)
+	for obj in objects:
+		free_paths(obj) #they belong to this level's fov map
+	levels.put(current_level)
+	
+	going_up = depth < dungeon_level
+	dungeon_level = depth
+	if level is None:
+		enter_level(take_level(depth))
+	elif going_up:
+		enter_level(level, (level.downstairs.x, level.downstairs.y))
+	else:
+		enter_level(level, (level.upstairs.x, level.upstairs.y))
+	initialize_fov()
+	
+	if depth + 1 not in levels:
+		pregenerate_level(depth + 1)
+		
+def next_level():
 	#advance to next level
 	message('You carefully walk down the stairs.', libtcod.light_violet)
-	dungeon_level += 1
-	make_map() #create fresh new level
-	initialize_fov()
+	change_level(dungeon_level + 1)
 	save_game()
 
 def previous_level():
-	global dungeon_level
 	#go back up one floor
+	if dungeon_level == 1:
+		message('The way up is blocked.', libtcod.light_red)
+		return
 	message('You go back up.', libtcod.light_red)
-	dungeon_level -= 1
-	load_previous_map() # load the last map 
-	initialize_fov()
+	change_level(dungeon_level - 1)
 	
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 	#render a bar (HP, XP, MANA etc). First calculate the width of the bar
@@ -933,49 +2420,73 @@ def to_camera_coordinates(x, y):
 	
 	return (x, y)
 	
+def camera_window(layer, fill=False):
+	#the part of a map layer (an [x, y] array) that is under the camera
+	#camera cells that fall outside the map get the fill value
+	window = numpy.empty((CAMERA_WIDTH, CAMERA_HEIGHT), dtype=layer.dtype)
+	window.fill(fill)
+	
+	(x1, y1) = (max(camera_x, 0), max(camera_y, 0))
+	(x2, y2) = (min(camera_x + CAMERA_WIDTH, MAP_WIDTH), min(camera_y + CAMERA_HEIGHT, MAP_HEIGHT))
+	window[x1 - camera_x:x2 - camera_x, y1 - camera_y:y2 - camera_y] = layer[x1:x2, y1:y2]
+	return window
+	
+def in_fov(x, y):
+	#is the map tile visible, according to the last FOV snapshot?
+	if x < 0 or y < 0 or x >= MAP_WIDTH or y >= MAP_HEIGHT:
+		return False
+	return fov_visible[x, y]
+	
+def update_fov():
+	global fov_visible, fov_recompute
+	fov_recompute = False
+	libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+	#snapshot the result as an [x, y] array; everything reads from it instead of asking libtcod per cell
+	fov_visible = libtcod.map_get_fov(fov_map).T
+	
+	#everything that is visible is now explored
+	map.explored[:] |= fov_visible
+	
 def render_all():
-	global fov_map
+	global fov_map, fov_visible
 	global fov_recompute
+	global screen_cells
 
 	
 	
 	move_camera(player.x, player.y)
 	
+	if not rendering:
+		#nothing is drawn, but the game still needs the fov
+		if fov_recompute:
+			update_fov()
+		return
+		
 	if fov_recompute:
 		#recompute FOV if needed (player moved or w/e)
-		fov_recompute = False
-		libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-		libtcod.console_clear(con)
-		
-		#go through all the tiles, and set their background colour
-		for y in range(CAMERA_HEIGHT):
-			for x in range(CAMERA_WIDTH):
-				(map_x, map_y) = (camera_x + x, camera_y + y)
-				visible = libtcod.map_is_in_fov(fov_map, map_x, map_y)
-				
-				wall = map[map_x][map_y].block_sight
-				if not visible:
-					#if it's not visible right now, player can only see it when explored
-					if map[map_x][map_y].explored:
-						if wall:
-							#explored WALLS we can't see and the character on the wall:
-							libtcod.console_put_char_ex(con, x, y, char_for_dark_walls, char_color_on_dark_walls, color_dark_wall)					
-						else:
-							#explored FLOORS we can't see:
-							#libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET) 
-							libtcod.console_put_char_ex(con, x, y, character_dark_floorstyle, color_dark_ground, libtcod.BKGND_SET)
-							
-				else:
-					#it's visible
-					if wall:
-						#explored WALLS that are in view including the character on the wall:
-						libtcod.console_put_char_ex(con, x, y, char_for_light_walls, char_color_on_light_walls, color_light_wall)						
-					else:
-						#explored FLOORS that are in view:
-						#libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-						libtcod.console_put_char_ex(con, x, y, character_light_floorstyle, color_light_ground, libtcod.BKGND_SET)
-					#since it's visible, explore it
-					map[map_x][map_y].explored = True
+		update_fov()
+		
+		#work out what every camera cell shows now: visible cells are lit, explored ones dark, the rest blank
+		cells = numpy.where(camera_window(fov_visible), CELL_LIGHT_WALL,
+			numpy.where(camera_window(map.explored), CELL_DARK_WALL, CELL_UNEXPLORED)).astype(numpy.int8)
+		cells[(cells != CELL_UNEXPLORED) & ~camera_window(map.block_sight)] += 1 #walls -> grounds
+		
+		#and only repaint the cells that look different from the last frame, one kind of cell at a time
+		dirty = cells != screen_cells
+		screen_cells = cells
+		
+		#character, foreground and background of each kind of cell (unexplored is what clearing the console leaves)
+		looks = [(' ', libtcod.white, libtcod.black),
+			(char_for_dark_walls, char_color_on_dark_walls, color_dark_wall),
+			(character_dark_floorstyle, color_dark_ground, libtcod.black),
+			(char_for_light_walls, char_color_on_light_walls, color_light_wall),
+			(character_light_floorstyle, color_light_ground, libtcod.black)]
+		for (kind, (char, fore, back)) in enumerate(looks):
+			#the buffer is in rows of y, the cells are [x, y]
+			map_layer.set_mask((dirty & (cells == kind)).T, back, fore, char)
+			
+	#copy the whole map layer to con in a few calls, which also erases the objects drawn last frame
+	map_layer.blit(con)
 					
 	#draw all objects in the list, except player (should be drawn last, over all the other stuff like items and corpses)
 	for object in objects:
@@ -1024,6 +2535,19 @@ def message(new_msg, color = libtcod.white):
 		#add the new line as a tuple, with the text and color
 		game_msgs.append( (line, color) )
 
+def check_for_event():
+	#read the next key press or mouse event into key and mouse (and record it, if the session is recorded)
+	event = libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
+	if input_log is not None:
+		input_log.record(event, key, mouse)
+	return event
+	
+def wait_for_keypress():
+	pressed = libtcod.console_wait_for_keypress(True)
+	if input_log is not None:
+		input_log.record(libtcod.EVENT_KEY_PRESS, pressed, None)
+	return pressed
+	
 def msgbox(text, width=50):
 	menu(text, [], width) #use menu() as a sort of "message box"
 
@@ -1059,7 +2583,7 @@ def menu(header, options, width):
 	
 	#present the root console to the player and wait for a keypress
 	libtcod.console_flush()
-	key = libtcod.console_wait_for_keypress(True)
+	key = wait_for_keypress()
 	
 	if key.vk == libtcod.KEY_ENTER and key.lalt: #copied code: allow alt-enter in the main screen
 		libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())	
@@ -1131,8 +2655,8 @@ def player_move_or_attack(dx, dy):
 	
 	#try to find an attackable object there
 	target = None
-	for object in objects:
-		if object.fighter and object.x == x and object.y == y:
+	for object in objects.at(x, y):
+		if object.fighter:
 			target = object
 			break
 	
@@ -1194,8 +2718,8 @@ def handle_keys():
 			
 			if key_char == 'g':
 				#grab/pickup an item
-				for object in objects: #look for item in the players tile
-					if object.x == player.x and object.y == player.y and object.item:
+				for object in objects.at(player.x, player.y): #look for item in the players tile
+					if object.item:
 						object.item.pick_up()
 						break
 			
@@ -1236,8 +2760,8 @@ def get_names_under_mouse():
 	(x, y) = (camera_x + x, camera_y + y) #from screen to map coords
 	
 	#create a list with the names of all objects at the mouse coords and in FOV
-	names = [obj.name for obj in objects 
-		if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+	names = [obj.name for obj in objects.at(x, y)
+		if in_fov(obj.x, obj.y)]
 		
 	#join the names, seperated by commas
 	names = ', '.join(names)
@@ -1249,13 +2773,13 @@ def target_tile(max_range=None):
 	while True:
 		#render the screen, this erases(?) the inv and shows the names of objects under the mouse
 		libtcod.console_flush()
-		libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
+		check_for_event()
 		render_all()
 		
 		(x, y) = (mouse.cx, mouse.cy)
 		(x, y) = (camera_x + x, camera_y + y) #from screen to map coords
 		
-		if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and
+		if (mouse.lbutton_pressed and in_fov(x, y) and
 			(max_range is None or player.distance(x, y) <= max_range)):
 			return (x, y)
 		if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
@@ -1269,8 +2793,8 @@ def target_monster(max_range=None):
 			return None
 		
 		#return the first clicked monster, otherwise continue looping
-		for obj in objects:
-			if obj.x == x and obj.y == y and obj.fighter and obj != player:
+		for obj in objects.at(x, y):
+			if obj.fighter and obj != player:
 				return obj
 
 def check_level_up():
@@ -1316,14 +2840,23 @@ def monster_death(monster):
 	message('The ' + monster.name.capitalize() + ' is dead! You gain ' + str(monster.fighter.xp) + ' XP.', libtcod.orange)
 	monster.char = '%'
 	monster.color = libtcod.dark_red
-	monster.blocks = False
+	objects.set_blocks(monster, False)
 	monster.fighter = None
+	free_paths(monster)
 	monster.ai = None
 	monster.name = 'The remains of a ' + monster.name
 	monster.send_to_back()
 	#always show corpses y/n:
 	monster.always_visible = False
 
+def free_paths(obj):
+	#free the paths the object's ai (and the ais it stands in for) planned
+	ai = obj.ai
+	while ai is not None:
+		if getattr(ai, 'path_cache', None) is not None:
+			ai.path_cache.free()
+		ai = getattr(ai, 'old_ai', None)
+		
 def monster_idle(monster):
 	#the monster stands around doing nothing
 	monster.ai = None
@@ -1335,7 +2868,7 @@ def closest_monster(max_range):
 	closest_dist = max_range + 1 #start with slightly more than max range
 	
 	for object in objects:
-		if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+		if object.fighter and not object == player and in_fov(object.x, object.y):
 			#calculate distance between object and player
 			dist = player.distance_to(object)
 			if dist < closest_dist: #its closer, so remember it
@@ -1412,16 +2945,18 @@ def cast_dig():
 	
 	if (x < old_x and y == old_y) or (x > old_x and y == old_y) :
 		#dig horizontally
-		create_h_tunnel(old_x, x, old_y)
+		create_h_tunnel(map, old_x, x, old_y)
 		
 	elif (y < old_y and x == old_x) or (y > old_y and x == old_x):
 		#dig vertically
-		create_v_tunnel(old_y, y, old_x)
+		create_v_tunnel(map, old_y, y, old_x)
 		
 	elif (x < old_x and y < old_y) or (x > old_x and y > old_y):
 		#dig diagonally
-		create_d_tunnel(old_x, x, old_y, y, x, y)
+		create_d_tunnel(map, old_x, x, old_y, y, x, y)
 	
+	#the new tunnel lets light and monsters through (paths get planned again, the map's version changed)
+	refresh_fov_map()
 	fov_recompute = True
 		
 	
@@ -1434,17 +2969,27 @@ def idle(num_turns):
 			
 ### INITIALIZATION & MAIN LOOP ###
 		
-libtcod.console_set_custom_font('arial10x10edit.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'ROGUETUT', False)
-libtcod.sys_set_fps(LIMIT_FPS)
+def initialize_console(headless=False):
+	#open the game window and create the off-screen consoles; a headless console has no window,
+	#it keeps the frames in memory and plays input pushed with libtcod.sys_push_event()
+	global con, panel
+	
+	if FOV_BACKEND is not None:
+		libtcod.map_set_backend(FOV_BACKEND)
+	if headless:
+		libtcod.console_set_backend(libtcod.CONSOLE_BACKEND_HEADLESS)
+		
+	libtcod.console_set_custom_font('arial10x10edit.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+	libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, 'ROGUETUT', False)
+	libtcod.sys_set_fps(LIMIT_FPS)
 
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+	con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
 
-#panel stuff
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+	#panel stuff
+	panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
 
 def new_game():
-	global player, inventory, game_msgs, game_state, dungeon_level
+	global player, inventory, game_msgs, game_state, dungeon_level, levels, next_serial
 	
 	#create object representing the player
 	fighter_component = Fighter(hp=50, defense=2, power=2, xp=0, death_function=player_death)
@@ -1453,12 +2998,23 @@ def new_game():
 	#player xp level
 	player.level = 1
 	
-	#dungeon floor we are at
+	#dungeon floor we are at, and the ones left behind (none yet, the files of an old game are deleted)
 	dungeon_level = 1
+	levels = LevelStore()
+	levels.clear()
+	save_journal.reset()
+	next_serial = 0
+	
+	#the master seed everything random in this game comes from
+	seed = GAME_SEED
+	if seed is None:
+		seed = libtcod.random_get_int(0, 0, 0x7fffffff)
+	start_random(seed)
 	
 	#generate map (at this point it's not drawn to the screen)	
 	make_map()
 	initialize_fov()
+	pregenerate_level(dungeon_level + 1)
 	
 	game_state = 'playing'
 	#list of items that starts empty
@@ -1477,61 +3033,270 @@ def new_game():
 	equipment_component.equip()
 	obj.always_visible = True
 	
+def refresh_fov_map():
+	#copy the map's tiles to the FOV map (also used for paths), e.g. after digging
+	#the grid is indexed [x, y], the FOV map wants rows of y: the transposed layers fill it in one call
+	libtcod.map_set_properties_bulk(fov_map, ~map.block_sight.T, ~map.blocked.T)
+	
 def initialize_fov():
-	global fov_recompute, fov_map
+	global fov_recompute, fov_map, fov_visible
+	global screen_cells, map_layer, chase_field
 	fov_recompute = True
 	
 	#create the FOV map, according to generated map
 	fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-	for y in range(MAP_HEIGHT):
-		for x in range(MAP_WIDTH):
-			libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+	refresh_fov_map()
+	
+	#monsters work out their way to the player on the new map
+	chase_field = None
+	
+	#nothing is visible until the first FOV computation
+	fov_visible = numpy.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=bool)
 	
 	libtcod.console_clear(con) #unexplored areas start with the default bg color (black)
+	
+	#the look of every camera cell as last drawn, and the map layer drawn with it (the size of con)
+	screen_cells = numpy.zeros((CAMERA_WIDTH, CAMERA_HEIGHT), dtype=numpy.int8)
+	map_layer = libtcod.NumpyConsoleBuffer(MAP_WIDTH, MAP_HEIGHT, fore_r=255, fore_g=255, fore_b=255)
 
 	
 	
+def replace_file(source, target):
+	#move source over target in one step, so a crash leaves either the old file or the new one. python 2
+	#on windows can't rename over a file, only there the old one is removed first
+	if hasattr(os, 'replace'):
+		os.replace(source, target)
+		return
+	try:
+		os.rename(source, target)
+	except OSError:
+		if not os.path.exists(target):
+			raise
+		os.remove(target)
+		os.rename(source, target)
+		
+def write_save(path, sections, compression=None):
+	#write a save file: the header, the table of contents and the sections (name -> bytes), in the order
+	#of their names. it's written next to the old file first, which is only replaced once all is written
+	if compression is None:
+		compression = SAVE_COMPRESSION
+	if compression == 'lzma' and lzma is None:
+		compression = 'zlib'
+	code = dict((name, code) for (code, name) in SaveReader.COMPRESSIONS.items())[compression]
+	
+	names = sorted(sections)
+	offset = SaveReader.HEADER.size + SaveReader.ENTRY.size * len(names)
+	contents = []
+	blobs = []
+	for name in names:
+		data = sections[name]
+		if compression == 'zlib':
+			blob = zlib.compress(data, 6)
+		elif compression == 'lzma':
+			blob = lzma.compress(data)
+		else:
+			blob = data
+		contents.append(SaveReader.ENTRY.pack(name.encode('ascii'), code, offset, len(blob), len(data),
+			zlib.crc32(data) & 0xffffffff))
+		blobs.append(blob)
+		offset += len(blob)
+	contents = b''.join(contents)
+	
+	with open(path + '.tmp', 'wb') as file:
+		file.write(SaveReader.HEADER.pack(SaveReader.MAGIC, SAVE_FORMAT_VERSION, len(names),
+			zlib.crc32(contents) & 0xffffffff))
+		file.write(contents)
+		for blob in blobs:
+			file.write(blob)
+		file.flush()
+		os.fsync(file.fileno())
+	replace_file(path + '.tmp', path)
+	
+def encode_tiles(grid):
+	#the tile layers, packed: width and height, then the bit-packed flag layers and the tile kinds
+	layers = [numpy.packbits(grid.blocked), numpy.packbits(grid.block_sight), numpy.packbits(grid.explored)]
+	return (struct.pack('<HH', grid.width, grid.height) + b''.join(layer.tobytes() for layer in layers) +
+		numpy.ascontiguousarray(grid.tiles.kind).tobytes())
+		
+def decode_tiles(data):
+	(width, height) = struct.unpack_from('<HH', data)
+	grid = TileGrid(width, height)
+	size = width * height
+	packed = (size + 7) // 8
+	start = 4
+	for name in ('blocked', 'block_sight', 'explored'):
+		bits = numpy.frombuffer(data, dtype=numpy.uint8, count=packed, offset=start)
+		grid.tiles[name] = numpy.unpackbits(bits)[:size].reshape(width, height).astype(bool)
+		start += packed
+	grid.tiles['kind'] = numpy.frombuffer(data, dtype=numpy.uint8, count=size, offset=start).reshape(width, height)
+	grid.clear_blockers()
+	return grid
+	
+def object_records(objects, codec=None):
+	#the entities as typed records, in order, with their schemas. the uid of an entity is its place in
+	#the list
+	codec = RecordCodec() if codec is None else codec
+	records = [codec.encode(obj) for obj in objects]
+	return {'schemas': codec.schemas, 'records': records}
+	
+def encode_objects(section):
+	#the records of object_records(), packed (see RecordCodec.pack)
+	return RecordCodec(section['schemas']).pack(section['records'])
+	
+def decode_objects(data):
+	return RecordCodec().unpack(data)[0]
+	
+def decode_records(section):
+	codec = RecordCodec(section['schemas'])
+	return [codec.decode(record) for record in section['records']]
+	
+def snapshot_level(level, codec):
+	#what encode_level() needs of a level, taken so play can go on changing the level: its info (with the
+	#stairs as entity uids), a copy of the tile layers, and its entities as typed records encoded with codec
+	grid = Blank()
+	grid.__class__ = TileGrid
+	(grid.width, grid.height, grid.tiles) = (level.map.width, level.map.height, level.map.tiles.copy())
+	info = {'depth': level.depth, 'seed': level.seed, 'start': level.start, 'look': codec.encode(level.look),
+		'regions': level.regions, 'downstairs': level.objects.index(level.downstairs),
+		'upstairs': level.objects.index(level.upstairs)}
+	records = [codec.encode(obj) for obj in level.objects]
+	return {'info': info, 'map': grid, 'records': records, 'schemas': list(codec.schemas)}
+	
+def encode_level(level):
+	#the sections of a level snapshot: its tiles, its objects and the rest
+	return {'level': json.dumps(level['info']).encode('utf-8'), 'tiles': encode_tiles(level['map']),
+		'objects': encode_objects(level)}
+		
+def decode_level(reader, entries=()):
+	#the level of a save file, with the changes of the journal entries applied (see SaveJournal)
+	info = reader.read_json('level')
+	grid = decode_tiles(reader.read('tiles'))
+	codec = RecordCodec()
+	(entities, numbers) = codec.unpack(reader.read('objects'))
+	(entities, numbers) = (dict(enumerate(entities)), dict(enumerate(numbers)))
+	order = list(range(len(entities)))
+	tiles = grid.tiles.reshape(-1)
+	for entry in entries:
+		codec.extend(entry.get('schemas', []))
+		for (uid, record) in entry.get('spawn', []):
+			(entities[uid], numbers[uid]) = (codec.decode(record), record['r'])
+		for (uid, changes) in entry.get('set', []):
+			(entity, fields) = (entities[uid], codec.schemas[numbers[uid]][1])
+			for (i, value) in changes:
+				setattr(entity, fields[i], codec.decode(value, entity))
+		for uid in entry.get('remove', []):
+			del entities[uid]
+			del numbers[uid]
+		order = entry.get('order', order)
+		if 'tiles' in entry:
+			(changed, values) = (entry['tiles'][0], numpy.array(entry['tiles'][1], dtype=int))
+			tiles['blocked'][changed] = values & 1
+			tiles['block_sight'][changed] = values >> 1 & 1
+			tiles['explored'][changed] = values >> 2 & 1
+			tiles['kind'][changed] = values >> 3
+	grid.clear_blockers()
+	
+	objects = ObjectRegistry([entities[uid] for uid in order], grid)
+	level = Level(info['depth'], info['seed'], grid, objects)
+	level.start = tuple(info['start'])
+	level.look = codec.decode(info['look'])
+	level.regions = info['regions']
+	level.downstairs = entities[info['downstairs']]
+	level.upstairs = entities[info['upstairs']]
+	return level
+	
+def read_journal(path, generation):
+	#the entries of the journal at path, if it's the one of that generation. reading stops at an entry
+	#that isn't whole (the game stopped while it was being written)
+	if not os.path.exists(path):
+		return []
+	with open(path, 'rb') as file:
+		data = file.read()
+	if len(data) < SaveJournal.HEADER.size:
+		return []
+	(magic, version, number) = SaveJournal.HEADER.unpack_from(data)
+	if magic != SaveJournal.MAGIC or version != SAVE_FORMAT_VERSION or number != generation:
+		return []
+	entries = []
+	start = SaveJournal.HEADER.size
+	while start + SaveJournal.ENTRY.size <= len(data):
+		(size, crc, compressed) = SaveJournal.ENTRY.unpack_from(data, start)
+		start += SaveJournal.ENTRY.size
+		payload = data[start:start + size]
+		if len(payload) != size or zlib.crc32(payload) & 0xffffffff != crc:
+			break
+		if compressed:
+			payload = zlib.decompress(payload)
+		entries.append(json.loads(payload.decode('utf-8')))
+		start += size
+	return entries
+	
 def save_game():
-	#open a new empty shelve (possibly overwriting an old one) to write the game data
-	file = shelve.open('savegame', 'n')	
-	file['map'] = map
-	file['objects'] = objects
-	file['player_index'] = objects.index(player) #index of player in objects list
-	file['inventory'] = inventory
-	file['game_msgs'] = game_msgs
-	file['game_state'] = game_state
-	file['stairs_index'] = objects.index(downstairs)
-	file['stairs_index'] = objects.index(upstairs)
-	file['dungeon_level'] = dungeon_level
-	file.close()
+	#save the game: a snapshot of the current level, the inventory and the rest (the entities encoded as
+	#records) goes to the save writer, which writes it while play goes on. it's mostly a small entry in the
+	#journal (see SaveJournal)
+	global next_serial
+	for obj in objects:
+		if getattr(obj, 'serial', None) is None: #new since the last save (or from a save without serials)
+			obj.serial = next_serial
+			next_serial += 1
+	game = {
+		'player': objects.index(player), #place of the player among the level's objects
+		'game_msgs': RecordCodec().encode(game_msgs),
+		'game_state': game_state,
+		'dungeon_level': dungeon_level,
+		'game_seed': game_seed,
+		'next_serial': next_serial}
+	snapshot = (snapshot_level(current_level, save_journal.codec), [obj.serial for obj in objects],
+		object_records(inventory), game)
+	save_writer.submit(SAVE_FILE, save_journal.write, snapshot)
+	
+	#the levels left behind go to their own files
+	levels.flush()
 
 def load_game():
-	#open the previously saved shelve and load the game data
+	#read the game back from the save file
 	global map, objects, player, inventory, game_msgs, game_state, downstairs, upstairs, dungeon_level
-	
-	file = shelve.open('savegame', 'r')
-	map = file['map']
-	objects = file['objects']
-	player = objects[file['player_index']] #get index of player in objects list and access it
-	inventory = file['inventory']
-	game_msgs = file['game_msgs']
-	game_state = file['game_state']
-	downstairs = objects[file['stairs_index']]
-	upstairs = objects[file['stairs_index']]
-	dungeon_level = file['dungeon_level']
-	file.close()
-	initialize_fov()
-	
-def load_previous_map():
-	#open the last map cus we done gone up a stairs
-	global map, game_state
-	
-	file = shelve.open('savegame', 'r')
-	map = file['map']
-	
-	game_state = file['game_state']
-	file.close()
+	global current_level, levels, next_serial
+	
+	save_writer.flush()
+	reader = SaveReader(SAVE_FILE)
+	try:
+		game = reader.read_json('game')
+		entries = []
+		if 'journal' in reader:
+			entries = read_journal(SAVE_JOURNAL, reader.read_json('journal')['generation'])
+		current_level = decode_level(reader, entries)
+		inventory = decode_objects(reader.read('inventory'))
+	finally:
+		reader.close()
+	sections = [entry['inventory'] for entry in entries if 'inventory' in entry]
+	if sections:
+		inventory = decode_records(sections[-1])
+	for entry in entries:
+		game = entry.get('game', game)
+	
+	#the next save is a whole one again
+	save_journal.reset()
+		
+	map = current_level.map
+	objects = current_level.objects
+	player = objects[game['player']]
+	player.fighter.reindex_equipment(inventory)
+	game_msgs = [tuple(line) for line in RecordCodec().decode(game['game_msgs'])]
+	game_state = str(game['game_state'])
+	downstairs = current_level.downstairs
+	upstairs = current_level.upstairs
+	dungeon_level = game['dungeon_level']
+	next_serial = game.get('next_serial', 0)
+	start_random(game['game_seed'])
+	use_look(current_level.look)
+	
+	#the levels left behind are read from their files when the player gets back to them
+	levels = LevelStore()
 	initialize_fov()
+	if dungeon_level + 1 not in levels:
+		pregenerate_level(dungeon_level + 1)
 	
 	
 #############
@@ -1542,6 +3307,7 @@ def play_game():
 	global key, mouse, camera_x, camera_y
 	
 	player_action = None	
+	turns = 0
 	
 	mouse = libtcod.Mouse()
 	key = libtcod.Key()
@@ -1550,7 +3316,7 @@ def play_game():
 	
 	while not libtcod.console_is_window_closed():
 		
-		libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
+		check_for_event()
 		#render the screen
 		render_all()
 		libtcod.console_flush()
@@ -1559,23 +3325,91 @@ def play_game():
 		#check for level-ups before each turn
 		check_level_up()
 		
-		#erase all objects at their old locations, before they move
-		for object in objects:
-			object.clear()
-		
 		#handle keys and exit game if needed
 		player_action = handle_keys()
 		if player_action == 'exit':
 			save_game()
+			save_writer.flush()
 			break
 			
-		#let monsters take their turn
+		#let monsters take their turn(s), as many as their speed allows in one player turn
 		if game_state == 'playing' and player_action != 'didnt-take-turn':
-			for object in objects:
-				if object.ai:
-					object.ai.take_turn()
-		
-main_menu()
+			objects.scheduler.advance(TURN_LENGTH, (player.x, player.y))
+			
+			#autosave, mostly a small entry in the journal
+			turns += 1
+			if AUTOSAVE_TURNS and turns % AUTOSAVE_TURNS == 0:
+				save_game()
+		
+def read_input_log(path):
+	#the master seed and the events of an input log, as (event, key, mouse) for libtcod.sys_push_event()
+	with open(path, 'rb') as file:
+		data = file.read()
+	(magic, version, seed) = InputLog.HEADER.unpack_from(data)
+	if magic != InputLog.MAGIC or version != InputLog.VERSION:
+		raise ValueError('not an input log: ' + path)
+	events = []
+	for start in range(InputLog.HEADER.size, len(data) - InputLog.EVENT.size + 1, InputLog.EVENT.size):
+		(event, vk, c, key_flags, cx, cy, x, y, mouse_flags) = InputLog.EVENT.unpack_from(data, start)
+		(key, mouse) = (None, None)
+		if event & libtcod.EVENT_KEY:
+			key = libtcod.Key(vk, c)
+			for (i, name) in enumerate(InputLog.KEY_FLAGS):
+				setattr(key, name, bool(key_flags >> i & 1))
+		if event & libtcod.EVENT_MOUSE:
+			mouse = libtcod.Mouse(x, y, 0, 0, cx, cy)
+			for (i, name) in enumerate(InputLog.MOUSE_FLAGS):
+				setattr(mouse, name, bool(mouse_flags >> i & 1))
+		events.append((event, key, mouse))
+	return (seed, events)
+	
+def replay(path):
+	#play a session recorded with --record back through the game logic: headless, without drawing and as
+	#fast as it goes. it runs in a scratch directory, so the saves it makes leave the real ones alone (a
+	#session that continued a saved game can't be replayed). returns the number of events and the time taken
+	global GAME_SEED, rendering
+	(seed, events) = read_input_log(path)
+	GAME_SEED = seed
+	initialize_console(headless=True)
+	rendering = False
+	for (event, key, mouse) in events:
+		libtcod.sys_push_event(event, key, mouse)
+		
+	directory = os.getcwd()
+	scratch = tempfile.mkdtemp()
+	os.chdir(scratch)
+	try:
+		start = time.time()
+		main_menu()
+		save_writer.flush()
+		elapsed = time.time() - start
+	finally:
+		save_writer.flush()
+		os.chdir(directory)
+		shutil.rmtree(scratch)
+	return (len(events), elapsed)
+	
+if __name__ == '__main__':
+	#python roguetutv2.py --headless runs without a window (scripted input only, so it quits right away),
+	#--seed N starts new games from master seed N, --generator NAME picks the level generator (see
+	#MAP_GENERATOR), --record FILE records the input of the session to FILE
+	#and --replay FILE plays a recorded session back as fast as it goes
+	if '--seed' in sys.argv:
+		GAME_SEED = int(sys.argv[sys.argv.index('--seed') + 1])
+	if '--generator' in sys.argv:
+		MAP_GENERATOR = sys.argv[sys.argv.index('--generator') + 1]
+		if MAP_GENERATOR not in MAP_GENERATORS:
+			sys.exit('unknown generator %r, pick one of: %s' % (MAP_GENERATOR, ', '.join(MAP_GENERATORS)))
+	if '--replay' in sys.argv:
+		(count, elapsed) = replay(sys.argv[sys.argv.index('--replay') + 1])
+		print('replayed %d events in %.2fs, %.0f per second' % (count, elapsed, count / max(elapsed, 1e-9)))
+	else:
+		if '--record' in sys.argv:
+			if GAME_SEED is None:
+				GAME_SEED = libtcod.random_get_int(0, 0, 0x7fffffff)
+			input_log = InputLog(sys.argv[sys.argv.index('--record') + 1], GAME_SEED)
+		initialize_console(headless='--headless' in sys.argv)
+		main_menu()
 		
 		
 		
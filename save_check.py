@@ -0,0 +1,76 @@
+#
+# checks that a saved game comes back as it was: plays a few turns of a new
+# game headless, saves, loads it again through "Continue Last Game" and
+# compares the entities, the map and the first frame drawn after loading.
+# runs in a scratch directory, so real saves are left alone.
+#
+# usage: python save_check.py [seed] [turns]
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import libtcodpy as libtcod
+import roguetutv2 as game
+
+MOVES = [libtcod.KEY_UP, libtcod.KEY_RIGHT, libtcod.KEY_DOWN, libtcod.KEY_LEFT]
+
+def push_key(vk=libtcod.KEY_CHAR, c=0):
+	libtcod.sys_push_event(libtcod.EVENT_KEY_PRESS, key=libtcod.Key(vk, c, True))
+
+def state():
+	#what must survive saving and loading, as plain values (and the type of every string)
+	objects = [(obj.name, type(obj.name), obj.char, type(obj.char), obj.x, obj.y, obj.blocks,
+		(obj.color.r, obj.color.g, obj.color.b), obj.fighter and (obj.fighter.hp, obj.fighter.max_hp))
+		for obj in game.objects]
+	inventory = [(item.name, item.equipment and item.equipment.is_equipped) for item in game.inventory]
+	messages = [(line, type(line)) for (line, color) in game.game_msgs]
+	return (objects, inventory, messages, game.map.tiles.tobytes(), game.dungeon_level, game.game_state)
+
+def frame():
+	game.fov_recompute = True
+	game.render_all()
+	libtcod.console_flush()
+	return libtcod.console_get_frame_text()
+
+def main():
+	game.GAME_SEED = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+	turns = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+	directory = os.getcwd()
+	scratch = tempfile.mkdtemp()
+	os.chdir(scratch)
+	try:
+		game.initialize_console(headless=True)
+
+		#new game, a few turns, then escape saves and quits to the main menu, which quits too
+		push_key(c=ord('a'))
+		for i in range(turns):
+			push_key(MOVES[i % len(MOVES)])
+		push_key(libtcod.KEY_ESCAPE)
+		push_key(c=ord('c'))
+		game.main_menu()
+		(saved, saved_frame) = (state(), frame())
+
+		#continue the last game and quit right away, without saving again
+		libtcod.sys_clear_events()
+		push_key(c=ord('b'))
+		game.main_menu()
+		(loaded, loaded_frame) = (state(), frame())
+	finally:
+		game.save_writer.close()
+		os.chdir(directory)
+		shutil.rmtree(scratch)
+
+	names = ['objects', 'inventory', 'messages', 'tiles', 'dungeon level', 'game state']
+	differences = [name for (name, a, b) in zip(names, saved, loaded) if a != b]
+	if saved_frame != loaded_frame:
+		differences.append('frame')
+	if differences:
+		print('save round trip FAILED, differs in: ' + ', '.join(differences))
+		sys.exit(1)
+	print('save round trip ok: %d objects, %d items, dungeon level %d' % (len(saved[0]), len(saved[1]), saved[4]))
+
+if __name__ == '__main__':
+	main()